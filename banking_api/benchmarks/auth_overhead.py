@@ -0,0 +1,51 @@
+"""
+Microbenchmark of the authentication overhead of a request.
+
+Measures the time get_current_user takes per call for each JWT backend, without and with
+the cache of verified tokens. The PyJWT backend is skipped if PyJWT is not installed:
+
+    python banking_api/benchmarks/auth_overhead.py --calls 20000
+"""
+
+import argparse
+import os
+import sys
+import timeit
+from importlib.util import find_spec
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import security
+from cache import TTLCache
+
+
+def per_call_microseconds(token, calls):
+    seconds = timeit.timeit(lambda: security.get_current_user(token), number=calls)
+    return round(seconds / calls * 1_000_000, 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--calls", type=int, default=20000)
+    args = parser.parse_args()
+
+    token = security.create_access_token(data={"sub": "admin"})
+    backends = [name for name in security.JWT_DECODERS if name != "pyjwt"]
+    if find_spec("jwt"):
+        backends.append("pyjwt")
+
+    cache = security.validated_tokens
+    for backend in backends:
+        security.JWT_BACKEND = backend
+        security.validated_tokens = TTLCache(0, 0)
+        uncached = per_call_microseconds(token, args.calls)
+        security.validated_tokens = cache
+        cache.clear()
+        cached = per_call_microseconds(token, args.calls)
+        print(
+            f"{backend:>6}: {uncached:>8} us/call uncached, {cached:>6} us/call cached"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+Benchmark for the group commit queue of the transfers.
+
+Every thread sends transfers one after the other between its own two accounts, so the
+transfers don't wait on each other's row locks and the commits are the bottleneck. The
+transfers are applied one commit each with transfer_money, then through a
+GroupCommitQueue for every combination of max batch size and max wait. For each run we
+report the throughput, the p50/p99 latency of a transfer and the average batch size.
+
+Run it against the database configured with DATABASE_URL (the docker-compose one by
+default):
+
+    python banking_api/benchmarks/group_commit.py --threads 1,16,64 --transfers 100 \\
+        --max-batch 16,128 --max-wait-ms 0,1,5
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from banking_operations import create_account, create_customer, transfer_money
+from postgres_interface import POOL_SETTINGS, SessionLocal, engine
+from postgres_models import Customer
+from pydantic_models import TransferRequest
+from transfer_queue import GroupCommitQueue
+
+BENCHMARK_CUSTOMER_ID = 900_001
+
+
+def setup_accounts(threads, transfers):
+    db = SessionLocal()
+    try:
+        if not db.get(Customer, BENCHMARK_CUSTOMER_ID):
+            create_customer(db, BENCHMARK_CUSTOMER_ID, "Benchmark Group Commit")
+        return [
+            (
+                create_account(db, BENCHMARK_CUSTOMER_ID, float(transfers)).id,
+                create_account(db, BENCHMARK_CUSTOMER_ID, 0.0).id,
+            )
+            for _ in range(threads)
+        ]
+    finally:
+        db.close()
+
+
+def run(name, threads, transfers, submit):
+    """
+    Runs the transfers of every thread through submit(sender, receiver) and returns the
+    throughput and latencies.
+    """
+    pairs = setup_accounts(threads, transfers)
+
+    def worker(pair):
+        latencies = []
+        for _ in range(transfers):
+            start = time.perf_counter()
+            result = submit(*pair)
+            latencies.append((time.perf_counter() - start) * 1000)
+            assert not isinstance(result, dict) or "error" not in result, result
+        return latencies
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        latencies = [
+            latency for result in executor.map(worker, pairs) for latency in result
+        ]
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "mode": name,
+        "threads": threads,
+        "transfers_per_second": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies), 2),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99) - 1], 2),
+    }
+
+
+def direct(threads, transfers):
+    def submit(sender, receiver):
+        db = SessionLocal()
+        try:
+            return transfer_money(
+                db,
+                TransferRequest(from_account=sender, to_account=receiver, amount=1.0),
+            )
+        finally:
+            db.close()
+
+    return run("direct", threads, transfers, submit)
+
+
+def group_commit(threads, transfers, max_batch, max_wait_ms):
+    queue = GroupCommitQueue(max_batch=max_batch, max_wait_ms=max_wait_ms)
+
+    def submit(sender, receiver):
+        transfer = TransferRequest(from_account=sender, to_account=receiver, amount=1.0)
+        return queue.submit(transfer).result()
+
+    try:
+        result = run(
+            f"group batch={max_batch} wait={max_wait_ms}ms", threads, transfers, submit
+        )
+    finally:
+        queue.shutdown()
+    result["average_batch"] = queue.stats()["average_batch"]
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--threads", default="1,16,64", help="comma separated")
+    parser.add_argument("--transfers", type=int, default=100, help="per thread")
+    parser.add_argument("--max-batch", default="16,128", help="comma separated")
+    parser.add_argument("--max-wait-ms", default="0,1,5", help="comma separated")
+    args = parser.parse_args()
+
+    max_threads = max(int(threads) for threads in args.threads.split(","))
+    if max_threads > POOL_SETTINGS["pool_size"] + POOL_SETTINGS["max_overflow"]:
+        print(
+            "The direct mode opens one connection per thread, raise DB_POOL_SIZE or "
+            "DB_MAX_OVERFLOW to avoid measuring the pool wait"
+        )
+
+    for threads in (int(threads) for threads in args.threads.split(",")):
+        results = [direct(threads, args.transfers)]
+        for max_batch in (int(size) for size in args.max_batch.split(",")):
+            for max_wait_ms in (float(wait) for wait in args.max_wait_ms.split(",")):
+                results.append(
+                    group_commit(threads, args.transfers, max_batch, max_wait_ms)
+                )
+        for result in results:
+            print(
+                f"{result['threads']:>4} threads {result['mode']:>28}: "
+                f"{result['transfers_per_second']:>8} transfers/s, "
+                f"p50 {result['p50_ms']:>7} ms, p99 {result['p99_ms']:>7} ms"
+                + (
+                    f", {result['average_batch']} per batch"
+                    if "average_batch" in result
+                    else ""
+                )
+            )
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
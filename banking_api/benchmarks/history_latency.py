@@ -0,0 +1,157 @@
+"""
+Benchmark for the transfer history lookups.
+
+Seeds a large number of transactions between a set of benchmark accounts and measures the
+latency of the first history page of random accounts, before and after the change:
+
+- before: the OR filter on from_account / to_account, without the account indexes
+- after: the UNION ALL query of transfer_history_statement, with the account indexes
+
+The seeding uses generate_series, so it needs postgres. Run it against the database
+configured with DATABASE_URL (the docker-compose one by default):
+
+    python banking_api/benchmarks/history_latency.py --rows 10000000
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from banking_operations import transfer_history_statement
+from migrations import _transactions_account_indexes
+from postgres_interface import SessionLocal, create_tables, engine
+from postgres_models import Transaction
+from sqlalchemy import select, text
+
+BENCHMARK_CUSTOMER_ID = 900_001
+
+
+def seed(rows, accounts):
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                "INSERT INTO customers (id, name) VALUES (:id, 'History Benchmark') "
+                "ON CONFLICT DO NOTHING"
+            ),
+            {"id": BENCHMARK_CUSTOMER_ID},
+        )
+        account_ids = list(
+            conn.execute(
+                text(
+                    "INSERT INTO accounts (customer_id, balance) "
+                    "SELECT :customer_id, 0 FROM generate_series(1, :accounts) "
+                    "RETURNING id"
+                ),
+                {"customer_id": BENCHMARK_CUSTOMER_ID, "accounts": accounts},
+            ).scalars()
+        )
+        first, last = min(account_ids), max(account_ids)
+        conn.execute(
+            text(
+                """
+                INSERT INTO transactions (from_account, to_account, amount, timestamp)
+                SELECT
+                    :first + floor(random() * (:last - :first + 1))::int,
+                    :first + floor(random() * (:last - :first + 1))::int,
+                    round((random() * 1000)::numeric, 2),
+                    now() - random() * interval '365 days'
+                FROM generate_series(1, :rows)
+                """
+            ),
+            {"first": first, "last": last, "rows": rows},
+        )
+        conn.execute(text("ANALYZE transactions"))
+    return account_ids
+
+
+def cleanup():
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                "DELETE FROM transactions WHERE from_account IN "
+                "(SELECT id FROM accounts WHERE customer_id = :customer_id)"
+            ),
+            {"customer_id": BENCHMARK_CUSTOMER_ID},
+        )
+        conn.execute(
+            text("DELETE FROM accounts WHERE customer_id = :customer_id"),
+            {"customer_id": BENCHMARK_CUSTOMER_ID},
+        )
+        conn.execute(
+            text("DELETE FROM customers WHERE id = :id"), {"id": BENCHMARK_CUSTOMER_ID}
+        )
+
+
+def legacy_statement(account_id, limit):
+    return (
+        select(Transaction)
+        .where(
+            (Transaction.from_account == account_id)
+            | (Transaction.to_account == account_id)
+        )
+        .order_by(Transaction.timestamp.desc(), Transaction.id.desc())
+        .limit(limit)
+    )
+
+
+def measure(build_statement, account_ids, queries, limit):
+    db = SessionLocal()
+    latencies = []
+    try:
+        for account_id in random.choices(account_ids, k=queries):
+            start = time.perf_counter()
+            db.scalars(build_statement(account_id, limit)).all()
+            latencies.append((time.perf_counter() - start) * 1000)
+    finally:
+        db.close()
+    latencies.sort()
+    return {
+        "p50_ms": round(statistics.median(latencies), 3),
+        "p99_ms": round(
+            latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))], 3
+        ),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--accounts", type=int, default=1000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--limit", type=int, default=100, help="page size")
+    parser.add_argument("--keep", action="store_true", help="keep the seeded rows")
+    args = parser.parse_args()
+
+    create_tables()
+    account_ids = seed(args.rows, args.accounts)
+    try:
+        with engine.begin() as conn:
+            conn.execute(
+                text("DROP INDEX IF EXISTS ix_transactions_from_account_timestamp")
+            )
+            conn.execute(
+                text("DROP INDEX IF EXISTS ix_transactions_to_account_timestamp")
+            )
+        before = measure(legacy_statement, account_ids, args.queries, args.limit)
+
+        with engine.begin() as conn:
+            _transactions_account_indexes(conn)
+            conn.execute(text("ANALYZE transactions"))
+        after = measure(
+            transfer_history_statement, account_ids, args.queries, args.limit
+        )
+    finally:
+        if not args.keep:
+            cleanup()
+
+    print(json.dumps({"rows": args.rows, "before": before, "after": after}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
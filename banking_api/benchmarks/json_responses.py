@@ -0,0 +1,92 @@
+"""
+Benchmark of the JSON encoding of the large responses.
+
+Serves a history page of --items transactions from a route without database, so only
+the response is measured, in the three modes of the history routes: the default one,
+where FastAPI validates and encodes the dict with its response_model, the FastJSONResponse
+validated against HistoryPage (FAST_JSON) and the trusted one without validation
+(FAST_JSON_VALIDATE=false). For each mode we report the CPU time per response and the
+bytes encoded per second of CPU time:
+
+    python banking_api/benchmarks/json_responses.py --items 10,100,1000 --requests 200
+"""
+
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from pydantic_models import HistoryPage
+from responses import FastJSONResponse
+
+
+def history(items):
+    start = datetime(2024, 1, 1)
+    return {
+        "history": [
+            {
+                "from_account": 1,
+                "to_account": 2 + index % 10,
+                "amount": 10.25 + index,
+                "timestamp": start + timedelta(seconds=index),
+            }
+            for index in range(items)
+        ],
+        "next_cursor": "MjAyNC0wMS0wMVQwMDowMDowMHwx",
+    }
+
+
+def build_app(page):
+    app = FastAPI()
+
+    @app.get("/default", response_model=dict)
+    def default():
+        return page
+
+    @app.get("/validated")
+    def validated():
+        return FastJSONResponse(page, HistoryPage, validate=True)
+
+    @app.get("/trusted")
+    def trusted():
+        return FastJSONResponse(page, HistoryPage, validate=False)
+
+    return app
+
+
+def measure(client, path, requests):
+    size = len(client.get(path).content)
+    start = time.process_time()
+    for _ in range(requests):
+        client.get(path)
+    cpu = time.process_time() - start
+    return {
+        "cpu_ms": round(cpu / requests * 1000, 3),
+        "megabytes_per_second": round(size * requests / cpu / 1_000_000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--items", default="10,100,1000", help="comma separated")
+    parser.add_argument("--requests", type=int, default=200)
+    args = parser.parse_args()
+
+    for items in (int(items) for items in args.items.split(",")):
+        client = TestClient(build_app(history(items)))
+        # Includes the cost of the test client, which is the same in every mode
+        for mode in ("default", "validated", "trusted"):
+            result = measure(client, f"/{mode}", args.requests)
+            print(
+                f"{items:>6} items {mode:>9}: {result['cpu_ms']:>8} ms CPU/response, "
+                f"{result['megabytes_per_second']:>7} MB/s"
+            )
+
+
+if __name__ == "__main__":
+    main()
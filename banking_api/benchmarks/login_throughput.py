@@ -0,0 +1,61 @@
+"""
+Benchmark for the logins per second of POST /auth/token.
+
+Logs the admin user in from several threads at once, with and without the cache of
+verified passwords. Run it against the database configured with DATABASE_URL (the
+docker-compose one by default):
+
+    python banking_api/benchmarks/login_throughput.py --threads 8 --logins 50
+"""
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import security
+from cache import TTLCache
+from fastapi.testclient import TestClient
+from main import app
+from postgres_interface import create_tables, fill_tables
+
+
+def run(client, threads, logins):
+    def worker(_):
+        for _ in range(logins):
+            response = client.post(
+                "/auth/token", data={"username": "admin", "password": "admin123"}
+            )
+            assert response.status_code == 200
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(worker, range(threads)))
+    return round(threads * logins / (time.perf_counter() - start), 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--logins", type=int, default=50, help="per thread")
+    args = parser.parse_args()
+
+    create_tables()
+    fill_tables()
+    with TestClient(app) as client:
+        cache = security.verified_passwords
+        security.verified_passwords = TTLCache(0, 0)
+        without_cache = run(client, args.threads, args.logins)
+        security.verified_passwords = cache
+        with_cache = run(client, args.threads, args.logins)
+
+    print(f"bcrypt workers: {security.BCRYPT_WORKERS}")
+    print(f" without cache: {without_cache} logins/s")
+    print(f"    with cache: {with_cache} logins/s")
+
+
+if __name__ == "__main__":
+    main()
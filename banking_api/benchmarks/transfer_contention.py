@@ -0,0 +1,126 @@
+"""
+Benchmark for transfers contending on a single hot account.
+
+Every thread sends money from its own account to one shared "merchant" account, which is
+the worst case for lost updates. The legacy read-modify-write loop (two plain SELECTs and
+a balance change in Python) is measured next to the strategies of transfer_money, and for
+each of them we report the throughput and how much money went missing.
+
+Run it against the database configured with DATABASE_URL (the docker-compose one by
+default):
+
+    python banking_api/benchmarks/transfer_contention.py --threads 16 --transfers 200
+"""
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from banking_operations import TRANSFER_STRATEGIES, create_account, create_customer
+from postgres_interface import SessionLocal
+from postgres_models import Account, Customer, Transaction
+from pydantic_models import TransferRequest
+
+BENCHMARK_CUSTOMER_ID = 900_000
+
+
+def read_modify_write(db, transfer):
+    """The transfer loop used before the strategies were introduced."""
+    sender = db.query(Account).filter(Account.id == transfer.from_account).first()
+    receiver = db.query(Account).filter(Account.id == transfer.to_account).first()
+    if sender.balance < transfer.amount:
+        return {"error": "Insufficient funds, please check the balance"}
+    sender.balance -= transfer.amount
+    receiver.balance += transfer.amount
+    transaction = Transaction(
+        from_account=sender.id, to_account=receiver.id, amount=transfer.amount
+    )
+    db.add(transaction)
+    db.commit()
+    return transaction
+
+
+def setup_accounts(threads, transfers):
+    db = SessionLocal()
+    try:
+        if not db.get(Customer, BENCHMARK_CUSTOMER_ID):
+            create_customer(db, BENCHMARK_CUSTOMER_ID, "Benchmark Merchant")
+        merchant = create_account(db, BENCHMARK_CUSTOMER_ID, 0.0).id
+        senders = [
+            create_account(db, BENCHMARK_CUSTOMER_ID, float(transfers)).id
+            for _ in range(threads)
+        ]
+        return merchant, senders
+    finally:
+        db.close()
+
+
+def balances(account_ids):
+    db = SessionLocal()
+    try:
+        return {
+            account.id: account.balance
+            for account in db.query(Account).filter(Account.id.in_(account_ids))
+        }
+    finally:
+        db.close()
+
+
+def run(name, transfer_function, threads, transfers):
+    merchant, senders = setup_accounts(threads, transfers)
+
+    def worker(sender):
+        db = SessionLocal()
+        failures = 0
+        try:
+            for _ in range(transfers):
+                transfer = TransferRequest(
+                    from_account=sender, to_account=merchant, amount=1.0
+                )
+                try:
+                    result = transfer_function(db, transfer)
+                except Exception:  # pylint: disable=broad-except
+                    db.rollback()
+                    failures += 1
+                    continue
+                failures += isinstance(result, dict)
+            return failures
+        finally:
+            db.close()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        failures = sum(executor.map(worker, senders))
+    elapsed = time.perf_counter() - start
+
+    final = balances([merchant] + senders)
+    expected_total = float(threads * transfers)
+    return {
+        "strategy": name,
+        "transfers_per_second": round(threads * transfers / elapsed, 1),
+        "failed_transfers": failures,
+        "money_lost": round(expected_total - sum(final.values()), 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--transfers", type=int, default=200, help="per thread")
+    args = parser.parse_args()
+
+    strategies = {"read_modify_write": read_modify_write, **TRANSFER_STRATEGIES}
+    for name, transfer_function in strategies.items():
+        result = run(name, transfer_function, args.threads, args.transfers)
+        print(
+            f"{result['strategy']:>18}: {result['transfers_per_second']:>8} transfers/s, "
+            f"{result['failed_transfers']} failed, {result['money_lost']} lost"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""
+Module for the read-through cache of the account balances.
+
+GET /accounts/{account_id}/balance/ reads through the cache, and the operations changing
+a balance register the account with invalidate_on_commit, which drops the cached entry
+once their database transaction commits. Nothing is dropped if it rolls back.
+
+The cache is in-process by default. With several workers, an invalidation only reaches the
+cache of the worker that made the change and the other workers can serve the old balance
+for up to BALANCE_CACHE_TTL seconds. Set BALANCE_CACHE_URL to share the cache between the
+workers through redis instead.
+"""
+
+import itertools
+import os
+
+from cache import TTLCache
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+BALANCE_CACHE_SIZE = int(os.getenv("BALANCE_CACHE_SIZE", "10000"))
+BALANCE_CACHE_TTL = float(os.getenv("BALANCE_CACHE_TTL", "5"))
+# e.g. redis://localhost:6379/0, requires the redis package
+BALANCE_CACHE_URL = os.getenv("BALANCE_CACHE_URL")
+
+# Key of the accounts to invalidate in Session.info
+_PENDING_INVALIDATIONS = "balance_cache_invalidations"
+
+
+class LocalBalanceCache:
+    """
+    In-process balance cache.
+    A read that started before an invalidation of the same account does not store its
+    result, so a balance read just before a transfer commits can't be cached after it.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._balances = TTLCache(maxsize, ttl)
+        # account id -> invalidation number, kept as long as a read can be in flight
+        self._invalidated = TTLCache(maxsize, ttl)
+        self._invalidation_numbers = itertools.count(1)
+        self._last_invalidation = 0
+        self.invalidations = 0
+
+    def get(self, account_id: int):
+        return self._balances.get(account_id)
+
+    def start_read(self):
+        """Returns the token to pass to set() after reading the balance from the database"""
+        return self._last_invalidation
+
+    def set(self, account_id: int, balance: float, token=None):
+        invalidated = self._invalidated.get(account_id)
+        if token is not None and invalidated is not None and invalidated > token:
+            return
+        self._balances.set(account_id, balance)
+
+    def invalidate(self, account_ids):
+        for account_id in account_ids:
+            self._last_invalidation = next(self._invalidation_numbers)
+            self._invalidated.set(account_id, self._last_invalidation)
+            self._balances.pop(account_id)
+            self.invalidations += 1
+
+    def clear(self):
+        self._balances.clear()
+
+    def stats(self) -> dict:
+        return {
+            "backend": "local",
+            **self._balances.stats(),
+            "invalidations": self.invalidations,
+        }
+
+
+class RedisBalanceCache:
+    """
+    Balance cache shared by the workers through redis.
+    The hit and miss counters are per worker.
+    """
+
+    def __init__(self, url: str, ttl: float):
+        import redis  # pylint: disable=import-outside-toplevel
+
+        self._client = redis.Redis.from_url(url)
+        self._ttl_ms = int(ttl * 1000)
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _key(account_id: int) -> str:
+        return f"balance:{account_id}"
+
+    def get(self, account_id: int):
+        value = self._client.get(self._key(account_id))
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return float(value)
+
+    def start_read(self):
+        return None
+
+    def set(self, account_id: int, balance: float, token=None):
+        self._client.set(self._key(account_id), balance, px=self._ttl_ms)
+
+    def invalidate(self, account_ids):
+        keys = [self._key(account_id) for account_id in account_ids]
+        if keys:
+            self._client.delete(*keys)
+            self.invalidations += len(keys)
+
+    def clear(self):
+        keys = list(self._client.scan_iter(self._key("*")))
+        if keys:
+            self._client.delete(*keys)
+
+    def stats(self) -> dict:
+        return {
+            "backend": "redis",
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+        }
+
+
+if BALANCE_CACHE_URL:
+    balances = RedisBalanceCache(BALANCE_CACHE_URL, BALANCE_CACHE_TTL)
+else:
+    balances = LocalBalanceCache(BALANCE_CACHE_SIZE, BALANCE_CACHE_TTL)
+
+
+def invalidate_on_commit(db: Session, *account_ids: int):
+    """
+    Function that drops the cached balances of the accounts when the transaction of the
+    session commits. For an AsyncSession, pass its sync_session.
+
+    :param db: Session: The session changing the balances.
+    :param account_ids: int: The ids of the accounts.
+    """
+
+    db.info.setdefault(_PENDING_INVALIDATIONS, set()).update(account_ids)
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_after_commit(session):
+    account_ids = session.info.pop(_PENDING_INVALIDATIONS, None)
+    if account_ids:
+        balances.invalidate(account_ids)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_after_rollback(session):
+    session.info.pop(_PENDING_INVALIDATIONS, None)
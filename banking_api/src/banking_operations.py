@@ -1,6 +1,20 @@
-from postgres_models import Account, Customer, Transaction
-from pydantic_models import TransferRequest
-from sqlalchemy.orm import Session
+import os
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from balance_cache import invalidate_on_commit
+from idempotency import add_to_transaction
+from postgres_models import Account, Customer, IdempotencyKey, Transaction
+from pydantic_models import AccountCreate, CustomerCreate, TransferRequest
+from sqlalchemy import insert, select, tuple_, union_all, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, aliased
+from statements import account_statement_query, add_to_statements
+
+# The concurrency control used by transfer_money, see its docstring for the options.
+TRANSFER_STRATEGY = os.getenv("TRANSFER_STRATEGY", "atomic_update")
+# Number of rows inserted and committed together by the bulk operations
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", "5000"))
 
 
 def create_account(db: Session, customer_id: int, initial_deposit: float):
@@ -23,15 +37,34 @@ def create_account(db: Session, customer_id: int, initial_deposit: float):
     """
     new_account = Account(customer_id=customer_id, balance=initial_deposit)
     db.add(new_account)
+    db.flush()
+    # The id may have belonged to a deleted account with a cached balance
+    invalidate_on_commit(db, new_account.id)
     db.commit()
     db.refresh(new_account)
     return new_account
 
 
-def transfer_money(db: Session, transfer: TransferRequest):
+def transfer_money(
+    db: Session,
+    transfer: TransferRequest,
+    strategy: str = None,
+    idempotency_key: Optional[IdempotencyKey] = None,
+):
     """
     Function that is used for transferring money between two accounts.
-    Here we choose the first query result as the sender and receiver accounts.
+    The concurrency control is picked by the strategy (TRANSFER_STRATEGY by default):
+
+    - "atomic_update" debits and credits the accounts with conditional
+      UPDATE ... RETURNING statements, so the balance check and the write happen
+      in the database and concurrent transfers never lose an update.
+    - "row_lock" locks both accounts with SELECT ... FOR UPDATE before changing the
+      balances in Python.
+
+    In both cases the rows are touched in ascending account id order, so two transfers
+    going in opposite directions between the same accounts can not deadlock.
+    The idempotency key, if any, is committed with the transfer. If the key already
+    exists the commit raises an IntegrityError and nothing is transferred.
 
     args
     ----
@@ -39,31 +72,244 @@ def transfer_money(db: Session, transfer: TransferRequest):
         The database session
     transfer: TransferRequest
         The transfer request object
+    strategy: str
+        "atomic_update" or "row_lock", defaults to TRANSFER_STRATEGY
+    idempotency_key: Optional[IdempotencyKey]
+        The key of the request, see idempotency.py
 
     returns
     -------
     Transaction
         The transaction object
     """
-    sender = db.query(Account).filter(Account.id == transfer.from_account).first()
-    receiver = db.query(Account).filter(Account.id == transfer.to_account).first()
+    strategy = strategy or TRANSFER_STRATEGY
+    if strategy not in TRANSFER_STRATEGIES:
+        raise ValueError(f"Unknown transfer strategy: {strategy}")
+    return TRANSFER_STRATEGIES[strategy](db, transfer, idempotency_key)
+
+
+def debit_statement(transfer: TransferRequest):
+    """
+    The conditional debit of the sender, it only matches if the balance is sufficient
+    """
+    return (
+        update(Account)
+        .where(Account.id == transfer.from_account, Account.balance >= transfer.amount)
+        .values(balance=Account.balance - transfer.amount)
+        .returning(Account.id)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def credit_statement(transfer: TransferRequest):
+    """
+    The credit of the receiver, it only matches if the account exists
+    """
+    return (
+        update(Account)
+        .where(Account.id == transfer.to_account)
+        .values(balance=Account.balance + transfer.amount)
+        .returning(Account.id)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def _transfer_atomic_update(
+    db: Session,
+    transfer: TransferRequest,
+    idempotency_key: Optional[IdempotencyKey] = None,
+):
+    debit = debit_statement(transfer)
+    credit = credit_statement(transfer)
+
+    if transfer.from_account <= transfer.to_account:
+        debited = db.execute(debit).first()
+        credited = debited and db.execute(credit).first()
+    else:
+        credited = db.execute(credit).first()
+        debited = credited and db.execute(debit).first()
+
+    if not debited or not credited:
+        db.rollback()
+        account_ids = {transfer.from_account, transfer.to_account}
+        found = db.query(Account.id).filter(Account.id.in_(account_ids)).count()
+        if found < len(account_ids):
+            return {"error": "Account not found, please check the account numbers"}
+        return {"error": "Insufficient funds, please check the balance"}
+
+    transaction = Transaction(
+        from_account=transfer.from_account,
+        to_account=transfer.to_account,
+        amount=transfer.amount,
+        timestamp=datetime.utcnow(),
+    )
+    db.add(transaction)
+    add_to_statements(
+        db,
+        [
+            (
+                transfer.from_account,
+                transfer.to_account,
+                transfer.amount,
+                transaction.timestamp,
+            )
+        ],
+    )
+    if idempotency_key is not None:
+        add_to_transaction(db, idempotency_key, transaction)
+    invalidate_on_commit(db, transfer.from_account, transfer.to_account)
+    db.commit()
+    return transaction
+
+
+def _transfer_row_lock(
+    db: Session,
+    transfer: TransferRequest,
+    idempotency_key: Optional[IdempotencyKey] = None,
+):
+    accounts = {
+        account.id: account
+        for account in db.query(Account)
+        .filter(Account.id.in_([transfer.from_account, transfer.to_account]))
+        .order_by(Account.id)
+        .with_for_update()
+    }
+    sender = accounts.get(transfer.from_account)
+    receiver = accounts.get(transfer.to_account)
 
     if not sender or not receiver:
+        db.rollback()
         return {"error": "Account not found, please check the account numbers"}
 
     if sender.balance < transfer.amount:
+        db.rollback()
         return {"error": "Insufficient funds, please check the balance"}
 
     sender.balance -= transfer.amount
     receiver.balance += transfer.amount
     transaction = Transaction(
-        from_account=sender.id, to_account=receiver.id, amount=transfer.amount
+        from_account=sender.id,
+        to_account=receiver.id,
+        amount=transfer.amount,
+        timestamp=datetime.utcnow(),
     )
     db.add(transaction)
+    add_to_statements(
+        db, [(sender.id, receiver.id, transfer.amount, transaction.timestamp)]
+    )
+    if idempotency_key is not None:
+        add_to_transaction(db, idempotency_key, transaction)
+    invalidate_on_commit(db, sender.id, receiver.id)
     db.commit()
     return transaction
 
 
+TRANSFER_STRATEGIES = {
+    "atomic_update": _transfer_atomic_update,
+    "row_lock": _transfer_row_lock,
+}
+
+
+def transfer_money_batch(
+    db: Session, transfers: List[TransferRequest], atomic: bool = True
+):
+    """
+    Function that is used for applying many transfers in a single database transaction.
+    All the accounts involved are loaded with one query and locked in ascending id order,
+    so concurrent batches touching the same accounts wait for each other instead of
+    deadlocking. Balances are updated in memory, the transactions are inserted with one
+    bulk insert, the statements are updated with one upsert and everything is committed
+    once.
+
+    args
+    ----
+    db: Session
+        The database session
+    transfers: List[TransferRequest]
+        The transfer request objects, applied in the given order
+    atomic: bool
+        If True, a single failing transfer rolls back the whole batch (all or nothing).
+        If False, failing transfers are skipped and the rest are committed (best effort).
+
+    returns
+    -------
+    Tuple[bool, List[dict]]
+        Whether the batch was committed and one result per transfer, in request order
+    """
+    account_ids = sorted(
+        {transfer.from_account for transfer in transfers}
+        | {transfer.to_account for transfer in transfers}
+    )
+    accounts = {
+        account.id: account
+        for account in db.query(Account)
+        .filter(Account.id.in_(account_ids))
+        .order_by(Account.id)
+        .with_for_update()
+    }
+
+    timestamp = datetime.utcnow()
+    results = []
+    rows = []
+    for index, transfer in enumerate(transfers):
+        sender = accounts.get(transfer.from_account)
+        receiver = accounts.get(transfer.to_account)
+
+        if not sender or not receiver:
+            error = "Account not found, please check the account numbers"
+        elif sender.balance < transfer.amount:
+            error = "Insufficient funds, please check the balance"
+        else:
+            error = None
+
+        if error:
+            results.append(
+                {"index": index, "success": False, "transaction": None, "error": error}
+            )
+            continue
+
+        sender.balance -= transfer.amount
+        receiver.balance += transfer.amount
+        row = {
+            "from_account": sender.id,
+            "to_account": receiver.id,
+            "amount": transfer.amount,
+            "timestamp": timestamp,
+        }
+        rows.append(row)
+        results.append(
+            {"index": index, "success": True, "transaction": row, "error": None}
+        )
+
+    if atomic and len(rows) != len(transfers):
+        db.rollback()
+        for result in results:
+            if result["success"]:
+                result.update(
+                    success=False,
+                    transaction=None,
+                    error="Not applied, another transfer in the batch failed",
+                )
+        return False, results
+
+    if rows:
+        db.execute(insert(Transaction), rows)
+        add_to_statements(
+            db,
+            [
+                (row["from_account"], row["to_account"], row["amount"], timestamp)
+                for row in rows
+            ],
+        )
+        invalidate_on_commit(
+            db,
+            *{row["from_account"] for row in rows},
+            *{row["to_account"] for row in rows},
+        )
+    db.commit()
+    return True, results
+
+
 def create_customer(db: Session, customer_id: int, name: str):
     """
     Function that is used for creating customer based on the customer_id and name
@@ -89,27 +335,261 @@ def create_customer(db: Session, customer_id: int, name: str):
     return new_customer
 
 
-def get_transfer_history(db: Session, account_id: int):
+def _chunks(items: list, chunk_size: int):
+    for start in range(0, len(items), chunk_size):
+        end = start + chunk_size
+        yield items[start:end]
+
+
+def create_customers_bulk(
+    db: Session, customers: List[CustomerCreate], chunk_size: int = BULK_CHUNK_SIZE
+):
+    """
+    Function that is used for creating many customers at once.
+    Every chunk of chunk_size customers is inserted with one multi-row INSERT ... RETURNING
+    and committed, so a failure only rolls back the chunk it happened in.
+
+    args
+    ----
+    db: Session
+        The database session
+    customers: List[CustomerCreate]
+        The customers to create
+    chunk_size: int
+        The number of customers inserted and committed together
+
+    returns
+    -------
+    List[int]
+        The ids of the created customers, in the order of the request.
+        If a chunk fails, an error with the ids created by the previous chunks
+    """
+    statement = insert(Customer).returning(Customer.id, sort_by_parameter_order=True)
+    ids = []
+    for chunk in _chunks(customers, chunk_size):
+        rows = [{"id": customer.id, "name": customer.name} for customer in chunk]
+        try:
+            chunk_ids = db.scalars(statement, rows).all()
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+            return {
+                "error": "A customer id already exists, the chunk was not created",
+                "created": ids,
+            }
+        ids += chunk_ids
+    return ids
+
+
+def create_accounts_bulk(
+    db: Session, accounts: List[AccountCreate], chunk_size: int = BULK_CHUNK_SIZE
+):
     """
-    Function that is used for getting the transfer history for a given account
+    Function that is used for creating many accounts at once.
+    Every chunk of chunk_size accounts is inserted with one multi-row INSERT ... RETURNING
+    and committed, so a failure only rolls back the chunk it happened in.
 
     args
     ----
     db: Session
         The database session
+    accounts: List[AccountCreate]
+        The accounts to create
+    chunk_size: int
+        The number of accounts inserted and committed together
+
+    returns
+    -------
+    List[Tuple[int, float]]
+        The (id, balance) of the created accounts, in the order of the request.
+        If a chunk fails, an error with the ids created by the previous chunks
+    """
+    statement = insert(Account).returning(
+        Account.id, Account.balance, sort_by_parameter_order=True
+    )
+    created = []
+    for chunk in _chunks(accounts, chunk_size):
+        rows = [
+            {"customer_id": account.customer_id, "balance": account.initial_deposit}
+            for account in chunk
+        ]
+        try:
+            result = db.execute(statement, rows).all()
+            invalidate_on_commit(db, *(account_id for account_id, _ in result))
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+            return {
+                "error": "Customer not found, the chunk was not created",
+                "created": [account_id for account_id, _ in created],
+            }
+        created += [tuple(row) for row in result]
+    return created
+
+
+def transfer_history_statement(
+    account_id: int,
+    limit: Optional[int] = None,
+    after: Optional[Tuple[datetime, int]] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+):
+    """
+    Function that builds the query for the transfer history of an account, newest first.
+    Pages are selected with a keyset on (timestamp, id) instead of an offset, so fetching
+    a page costs the same however deep into the history it is.
+
+    The outgoing and the incoming transactions are selected separately and combined with
+    UNION ALL. Each side is a range scan of the (from_account, timestamp, id) or the
+    (to_account, timestamp, id) index, where an OR of both columns would scan the table.
+    On postgres the transactions table is partitioned by month (see partitions.py),
+    a date range or a cursor only scans the partitions it overlaps.
+
+    args
+    ----
     account_id: int
         The account id
+    limit: Optional[int]
+        The maximum number of transactions to return
+    after: Optional[Tuple[datetime, int]]
+        The (timestamp, id) of the last transaction of the previous page
+    start: Optional[datetime]
+        Only return transactions made at or after this time
+    end: Optional[datetime]
+        Only return transactions made before this time
 
     returns
     -------
-    List[Transaction]
-        The list of transaction objects
+    Select
+        The select statement for the transactions
     """
-    return (
-        db.query(Transaction)
-        .filter(
-            (Transaction.from_account == account_id)
-            | (Transaction.to_account == account_id)
+
+    def side(statement):
+        if after is not None:
+            # The plain bound on the timestamp lets postgres skip the partitions newer
+            # than the cursor, it can't prune on the row comparison
+            statement = statement.where(
+                tuple_(Transaction.timestamp, Transaction.id) < tuple_(*after),
+                Transaction.timestamp <= after[0],
+            )
+        if start is not None:
+            statement = statement.where(Transaction.timestamp >= start)
+        if end is not None:
+            statement = statement.where(Transaction.timestamp < end)
+        if limit is not None:
+            statement = statement.order_by(
+                Transaction.timestamp.desc(), Transaction.id.desc()
+            ).limit(limit)
+        # Wrapped in a subquery because some databases (SQLite) reject ORDER BY and
+        # LIMIT directly inside a UNION
+        return select(statement.subquery())
+
+    outgoing = side(select(Transaction).where(Transaction.from_account == account_id))
+    # A transfer to the same account is already part of the outgoing side
+    incoming = side(
+        select(Transaction).where(
+            Transaction.to_account == account_id,
+            Transaction.from_account != account_id,
         )
-        .all()
     )
+    history = aliased(Transaction, union_all(outgoing, incoming).subquery())
+    statement = select(history).order_by(history.timestamp.desc(), history.id.desc())
+    if limit is not None:
+        statement = statement.limit(limit)
+    return statement
+
+
+def get_transfer_history(
+    db: Session,
+    account_id: int,
+    limit: Optional[int] = None,
+    after: Optional[Tuple[datetime, int]] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+):
+    """
+    Function that is used for getting the transfer history for a given account,
+    newest first. See transfer_history_statement for the arguments.
+
+    args
+    ----
+    db: Session
+        The database session
+    account_id: int
+        The account id
+
+    returns
+    -------
+    List[Transaction]
+        The list of transaction objects
+    """
+    return db.scalars(
+        transfer_history_statement(account_id, limit, after, start, end)
+    ).all()
+
+
+def get_account_statement(
+    db: Session,
+    account_id: int,
+    period: str = "month",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+):
+    """
+    Function that is used for getting the statement of an account, its totals per day
+    or per month, oldest first. They are read from the account_statements table, one
+    row per period, see statements.py.
+
+    args
+    ----
+    db: Session
+        The database session
+    account_id: int
+        The account id
+    period: str
+        "day" or "month"
+    start: Optional[datetime]
+        Only return the periods starting at or after this time
+    end: Optional[datetime]
+        Only return the periods starting before this time
+
+    returns
+    -------
+    List[AccountStatement]
+        The statement rows
+    """
+    return db.scalars(account_statement_query(account_id, period, start, end)).all()
+
+
+def iter_transfer_history(
+    db: Session,
+    account_id: int,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    batch_size: int = 1000,
+):
+    """
+    Function that streams the whole transfer history of an account, newest first.
+    Rows are fetched from a server side cursor batch_size at a time, so the memory used
+    does not depend on the size of the history.
+
+    args
+    ----
+    db: Session
+        The database session, it has to stay open while the generator is consumed
+    account_id: int
+        The account id
+    start: Optional[datetime]
+        Only return transactions made at or after this time
+    end: Optional[datetime]
+        Only return transactions made before this time
+    batch_size: int
+        The number of rows fetched per round trip
+
+    returns
+    -------
+    Iterator[Transaction]
+        The transaction objects
+    """
+    statement = transfer_history_statement(account_id, start=start, end=end)
+    yield from db.scalars(statement.execution_options(yield_per=batch_size))
@@ -0,0 +1,279 @@
+"""
+Async variants of the banking operations, used when USE_ASYNC_DB is set.
+They mirror the functions in banking_operations but run on an AsyncSession, so a request
+waiting on the database does not hold a threadpool worker.
+"""
+
+from datetime import datetime
+from typing import Optional, Tuple
+
+from balance_cache import invalidate_on_commit
+from banking_operations import (
+    TRANSFER_STRATEGY,
+    credit_statement,
+    debit_statement,
+    transfer_history_statement,
+)
+from idempotency import add_to_transaction
+from postgres_models import Account, Customer, IdempotencyKey, Transaction
+from pydantic_models import TransferRequest
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from statements import account_statement_query, statement_upsert
+
+
+async def create_account(db: AsyncSession, customer_id: int, initial_deposit: float):
+    """
+    Function that is used for creating account based on the customer_id and initial_deposit
+
+    args
+    ----
+    db: AsyncSession
+        The async database session
+    customer_id: int
+        The customer id
+    initial_deposit: float
+        The initial deposit amount
+
+    returns
+    -------
+    Account
+        The account object
+    """
+    new_account = Account(customer_id=customer_id, balance=initial_deposit)
+    db.add(new_account)
+    await db.flush()
+    invalidate_on_commit(db.sync_session, new_account.id)
+    await db.commit()
+    return new_account
+
+
+async def get_account(db: AsyncSession, account_id: int):
+    """
+    Function that is used for getting an account by its id
+
+    args
+    ----
+    db: AsyncSession
+        The async database session
+    account_id: int
+        The account id
+
+    returns
+    -------
+    Account
+        The account object, or None if it does not exist
+    """
+    return await db.get(Account, account_id)
+
+
+async def transfer_money(
+    db: AsyncSession,
+    transfer: TransferRequest,
+    strategy: str = None,
+    idempotency_key: Optional[IdempotencyKey] = None,
+):
+    """
+    Function that is used for transferring money between two accounts.
+    It supports the same strategies as banking_operations.transfer_money.
+
+    args
+    ----
+    db: AsyncSession
+        The async database session
+    transfer: TransferRequest
+        The transfer request object
+    strategy: str
+        "atomic_update" or "row_lock", defaults to TRANSFER_STRATEGY
+    idempotency_key: Optional[IdempotencyKey]
+        The key of the request, committed with the transfer
+
+    returns
+    -------
+    Transaction
+        The transaction object
+    """
+    strategy = strategy or TRANSFER_STRATEGY
+    if strategy not in TRANSFER_STRATEGIES:
+        raise ValueError(f"Unknown transfer strategy: {strategy}")
+    return await TRANSFER_STRATEGIES[strategy](db, transfer, idempotency_key)
+
+
+async def _add_to_statements(db: AsyncSession, transaction: Transaction):
+    await db.execute(
+        statement_upsert(
+            db.bind.dialect.name,
+            [
+                (
+                    transaction.from_account,
+                    transaction.to_account,
+                    transaction.amount,
+                    transaction.timestamp,
+                )
+            ],
+        )
+    )
+
+
+async def _transfer_atomic_update(
+    db: AsyncSession,
+    transfer: TransferRequest,
+    idempotency_key: Optional[IdempotencyKey] = None,
+):
+    debit = debit_statement(transfer)
+    credit = credit_statement(transfer)
+
+    if transfer.from_account <= transfer.to_account:
+        debited = (await db.execute(debit)).first()
+        credited = debited and (await db.execute(credit)).first()
+    else:
+        credited = (await db.execute(credit)).first()
+        debited = credited and (await db.execute(debit)).first()
+
+    if not debited or not credited:
+        await db.rollback()
+        account_ids = {transfer.from_account, transfer.to_account}
+        found = await db.scalar(
+            select(func.count(Account.id)).where(Account.id.in_(account_ids))
+        )
+        if found < len(account_ids):
+            return {"error": "Account not found, please check the account numbers"}
+        return {"error": "Insufficient funds, please check the balance"}
+
+    transaction = Transaction(
+        from_account=transfer.from_account,
+        to_account=transfer.to_account,
+        amount=transfer.amount,
+        timestamp=datetime.utcnow(),
+    )
+    db.add(transaction)
+    await _add_to_statements(db, transaction)
+    if idempotency_key is not None:
+        add_to_transaction(db, idempotency_key, transaction)
+    invalidate_on_commit(
+        db.sync_session, transaction.from_account, transaction.to_account
+    )
+    await db.commit()
+    return transaction
+
+
+async def _transfer_row_lock(
+    db: AsyncSession,
+    transfer: TransferRequest,
+    idempotency_key: Optional[IdempotencyKey] = None,
+):
+    result = await db.scalars(
+        select(Account)
+        .where(Account.id.in_([transfer.from_account, transfer.to_account]))
+        .order_by(Account.id)
+        .with_for_update()
+    )
+    accounts = {account.id: account for account in result}
+    sender = accounts.get(transfer.from_account)
+    receiver = accounts.get(transfer.to_account)
+
+    if not sender or not receiver:
+        await db.rollback()
+        return {"error": "Account not found, please check the account numbers"}
+
+    if sender.balance < transfer.amount:
+        await db.rollback()
+        return {"error": "Insufficient funds, please check the balance"}
+
+    sender.balance -= transfer.amount
+    receiver.balance += transfer.amount
+    transaction = Transaction(
+        from_account=sender.id,
+        to_account=receiver.id,
+        amount=transfer.amount,
+        timestamp=datetime.utcnow(),
+    )
+    db.add(transaction)
+    await _add_to_statements(db, transaction)
+    if idempotency_key is not None:
+        add_to_transaction(db, idempotency_key, transaction)
+    invalidate_on_commit(
+        db.sync_session, transaction.from_account, transaction.to_account
+    )
+    await db.commit()
+    return transaction
+
+
+TRANSFER_STRATEGIES = {
+    "atomic_update": _transfer_atomic_update,
+    "row_lock": _transfer_row_lock,
+}
+
+
+async def create_customer(db: AsyncSession, customer_id: int, name: str):
+    """
+    Function that is used for creating customer based on the customer_id and name
+
+    args
+    ----
+    db: AsyncSession
+        The async database session
+    customer_id: int
+        The customer id
+    name: str
+        The customer name
+
+    returns
+    -------
+    Customer
+        The customer object
+    """
+    new_customer = Customer(id=customer_id, name=name)
+    db.add(new_customer)
+    await db.commit()
+    return new_customer
+
+
+async def get_transfer_history(
+    db: AsyncSession,
+    account_id: int,
+    limit: Optional[int] = None,
+    after: Optional[Tuple[datetime, int]] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+):
+    """
+    Function that is used for getting the transfer history for a given account,
+    newest first. See banking_operations.transfer_history_statement for the arguments.
+
+    args
+    ----
+    db: AsyncSession
+        The async database session
+    account_id: int
+        The account id
+
+    returns
+    -------
+    List[Transaction]
+        The list of transaction objects
+    """
+    result = await db.scalars(
+        transfer_history_statement(account_id, limit, after, start, end)
+    )
+    return result.all()
+
+
+async def get_account_statement(
+    db: AsyncSession,
+    account_id: int,
+    period: str = "month",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+):
+    """
+    Function that is used for getting the statement of an account, oldest period first.
+    See banking_operations.get_account_statement for the arguments.
+
+    returns
+    -------
+    List[AccountStatement]
+        The statement rows
+    """
+    result = await db.scalars(account_statement_query(account_id, period, start, end))
+    return result.all()
@@ -0,0 +1,75 @@
+"""
+Module with the in-process cache used by the API.
+"""
+
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Hashable, Optional
+
+
+class TTLCache:
+    """
+    Bounded mapping with least recently used eviction and a time to live per entry.
+    All operations are O(1) and thread safe. A cache with maxsize 0 stores nothing.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key -> (expires_at, value), ordered from the least to the most recently used
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key: Hashable, default=None):
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            expires_at, value = item
+            if expires_at <= now:
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value, ttl: Optional[float] = None):
+        """
+        Stores the value for ttl seconds (the cache ttl by default), evicting the least
+        recently used entries if the cache is full.
+        """
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key: Hashable, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,306 @@
+"""
+Module for the opt-in diagnostics of the API.
+
+When enabled, with DIAGNOSTICS=true or at runtime with PATCH /metrics/diagnostics:
+- statements slower than slow_query_ms are logged together with their EXPLAIN plan,
+- requests running the same statement repeated_query_threshold times or more are logged,
+  it usually means the rows are loaded one query at a time instead of in one query (N+1),
+- a profile_sample_rate fraction of the requests is profiled by sampling the stacks of
+  the threads serving requests every PROFILE_INTERVAL_MS. The samples are written to
+  PROFILE_DIR as folded stacks, the input of flamegraph.pl and speedscope.
+
+The last DIAGNOSTICS_HISTORY findings of each kind are also returned by
+GET /metrics/diagnostics. While disabled, the hooks only check a flag.
+"""
+
+import logging
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Optional
+
+from postgres_interface import env_flag
+from pydantic_models import DiagnosticsSettings, DiagnosticsSettingsUpdate
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.concurrency import run_in_threadpool
+
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR = os.getenv(
+    "PROFILE_DIR", os.path.join(tempfile.gettempdir(), "banking_api_profiles")
+)
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+DIAGNOSTICS_HISTORY = int(os.getenv("DIAGNOSTICS_HISTORY", "100"))
+
+settings = DiagnosticsSettings(
+    enabled=env_flag("DIAGNOSTICS"),
+    slow_query_ms=float(os.getenv("SLOW_QUERY_MS", "100")),
+    explain=env_flag("DIAGNOSTICS_EXPLAIN", default=True),
+    repeated_query_threshold=int(os.getenv("REPEATED_QUERY_THRESHOLD", "2")),
+    profile_sample_rate=float(os.getenv("PROFILE_SAMPLE_RATE", "0")),
+)
+
+slow_queries = deque(maxlen=DIAGNOSTICS_HISTORY)
+repeated_queries = deque(maxlen=DIAGNOSTICS_HISTORY)
+profiles = deque(maxlen=DIAGNOSTICS_HISTORY)
+
+# Source directory of the API, the profiled stacks have to go through it
+_SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class _RequestDiagnostics:
+    __slots__ = ("scope", "statements")
+
+    def __init__(self, scope):
+        self.scope = scope
+        # statement -> number of executions
+        self.statements = Counter()
+
+    @property
+    def route(self) -> Optional[str]:
+        return getattr(self.scope.get("route"), "path", None)
+
+
+_current_request: ContextVar[Optional[_RequestDiagnostics]] = ContextVar(
+    "current_request_diagnostics", default=None
+)
+
+
+def update_settings(update: DiagnosticsSettingsUpdate) -> DiagnosticsSettings:
+    """
+    Function that changes the diagnostics settings of this process.
+
+    :param update: DiagnosticsSettingsUpdate: The settings to change, the ones left out
+        keep their value.
+    :return: DiagnosticsSettings: The new settings.
+    """
+    global settings
+    settings = settings.model_copy(update=update.model_dump(exclude_unset=True))
+    return settings
+
+
+def findings() -> dict:
+    return {
+        "settings": settings.model_dump(),
+        "slow_queries": list(slow_queries),
+        "repeated_queries": list(repeated_queries),
+        "profiles": list(profiles),
+    }
+
+
+def explain(conn, statement: str, parameters) -> Optional[str]:
+    """
+    Function that returns the plan of a statement that just ran on the connection.
+    The EXPLAIN runs on a new cursor of the same connection, inside a savepoint on
+    postgres so that a failing EXPLAIN does not abort the transaction of the request.
+
+    :param conn: Connection: The SQLAlchemy connection that ran the statement.
+    :param statement: str: The statement, as sent to the database.
+    :param parameters: The parameters of the statement.
+    :return: Optional[str]: The plan, None if the statement can not be explained.
+    """
+    if statement.lstrip().split(None, 1)[0].upper() not in (
+        "SELECT",
+        "INSERT",
+        "UPDATE",
+        "DELETE",
+        "WITH",
+    ):
+        return None
+    dialect = conn.dialect.name
+    prefix = "EXPLAIN QUERY PLAN " if dialect == "sqlite" else "EXPLAIN "
+    savepoint = dialect == "postgresql"
+
+    cursor = conn.connection.dbapi_connection.cursor()
+    try:
+        if savepoint:
+            cursor.execute("SAVEPOINT diagnostics_explain")
+        try:
+            if parameters:
+                cursor.execute(prefix + statement, parameters)
+            else:
+                cursor.execute(prefix + statement)
+            rows = cursor.fetchall()
+        except Exception as error:  # pylint: disable=broad-except
+            if savepoint:
+                cursor.execute("ROLLBACK TO SAVEPOINT diagnostics_explain")
+            return f"EXPLAIN failed: {error}"
+        if savepoint:
+            cursor.execute("RELEASE SAVEPOINT diagnostics_explain")
+    finally:
+        cursor.close()
+    return "\n".join(" ".join(str(value) for value in row) for row in rows)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if settings.enabled and context is not None:
+        context._diagnostics_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, "_diagnostics_started", None)
+    if started is None:
+        return
+    duration_ms = (time.perf_counter() - started) * 1000
+    request = _current_request.get()
+    if request is not None:
+        request.statements[statement] += 1
+
+    if duration_ms >= settings.slow_query_ms:
+        plan = None
+        if settings.explain and not executemany:
+            plan = explain(conn, statement, parameters)
+        slow_queries.append(
+            {
+                "timestamp": datetime.utcnow().isoformat(),
+                "route": request.route if request is not None else None,
+                "duration_ms": round(duration_ms, 3),
+                "statement": statement,
+                "plan": plan,
+            }
+        )
+        logger.warning(
+            "Slow query (%.1f ms) on %s: %s\n%s",
+            duration_ms,
+            request.route if request is not None else "no request",
+            statement,
+            plan,
+        )
+
+
+def instrument_engines():
+    """
+    Function that installs the diagnostics query hooks on all the engines.
+    """
+    if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of the threads serving requests every interval seconds, from a
+    background thread. Only stacks going through the API source are kept, which leaves
+    out the idle threads, so concurrent requests show up in the samples too.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        # folded stack -> number of samples
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="diagnostics-profiler", daemon=True
+        )
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self) -> Counter:
+        self._stop.set()
+        self._thread.join()
+        return self.stacks
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            for frame in sys._current_frames().values():
+                stack = _folded_stack(frame)
+                if stack is not None:
+                    self.stacks[stack] += 1
+
+
+def _folded_stack(frame) -> Optional[str]:
+    names = []
+    in_api = False
+    while frame is not None:
+        code = frame.f_code
+        if code is SamplingProfiler._run.__code__:
+            return None
+        in_api = in_api or code.co_filename.startswith(_SRC_DIR)
+        names.append(f"{frame.f_globals.get('__name__', '?')}:{code.co_name}")
+        frame = frame.f_back
+    if not in_api:
+        return None
+    return ";".join(reversed(names))
+
+
+def _write_profile(method: str, route: str, stacks: Counter) -> str:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    name = re.sub(r"[^A-Za-z0-9]+", "_", route).strip("_") or "root"
+    path = os.path.join(
+        PROFILE_DIR,
+        f"{datetime.utcnow():%Y%m%dT%H%M%S}-{method}-{name}-{uuid.uuid4().hex[:8]}.folded",
+    )
+    with open(path, "w") as profile:
+        for stack, count in stacks.most_common():
+            profile.write(f"{stack} {count}\n")
+    return path
+
+
+def _stop_profiler(profiler: SamplingProfiler, method: str, route: str) -> str:
+    return _write_profile(method, route, profiler.stop())
+
+
+class DiagnosticsMiddleware:
+    """
+    ASGI middleware collecting the statements of a request and profiling a sample of
+    the requests. It passes the requests through while the diagnostics are disabled.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not settings.enabled:
+            await self.app(scope, receive, send)
+            return
+
+        request = _RequestDiagnostics(scope)
+        token = _current_request.set(request)
+        profiler = None
+        if random.random() < settings.profile_sample_rate:
+            profiler = SamplingProfiler(PROFILE_INTERVAL_MS / 1000)
+            profiler.start()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _current_request.reset(token)
+            route = request.route or "unmatched"
+            for statement, count in request.statements.items():
+                if count >= settings.repeated_query_threshold:
+                    repeated_queries.append(
+                        {
+                            "timestamp": datetime.utcnow().isoformat(),
+                            "route": route,
+                            "count": count,
+                            "statement": statement,
+                        }
+                    )
+                    logger.warning(
+                        "%s %s ran the same statement %d times: %s",
+                        scope["method"],
+                        route,
+                        count,
+                        statement,
+                    )
+            if profiler is not None:
+                path = await run_in_threadpool(
+                    _stop_profiler, profiler, scope["method"], route
+                )
+                profiles.append(
+                    {
+                        "timestamp": datetime.utcnow().isoformat(),
+                        "route": route,
+                        "samples": sum(profiler.stacks.values()),
+                        "path": path,
+                    }
+                )
@@ -0,0 +1,215 @@
+"""
+Module for the Idempotency-Key support of the transfers.
+
+A transfer made with an Idempotency-Key header stores its response in the
+idempotency_keys table, in the same database transaction as the transfer itself. A retry
+with the same key then gets the stored response back without touching the accounts, and
+two concurrent requests with the same key can't both commit because of the primary key.
+The recently used keys are also kept in memory, so most retries don't query the table.
+
+Keys expire after IDEMPOTENCY_KEY_TTL seconds and are deleted in batches by a background
+task every IDEMPOTENCY_CLEANUP_INTERVAL seconds.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Optional
+
+from cache import TTLCache
+from fastapi import HTTPException
+from postgres_interface import SessionLocal
+from postgres_models import IdempotencyKey, Transaction
+from pydantic import BaseModel
+from sqlalchemy import delete, select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_KEY_TTL = float(os.getenv("IDEMPOTENCY_KEY_TTL", "86400"))
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000"))
+IDEMPOTENCY_CLEANUP_INTERVAL = float(os.getenv("IDEMPOTENCY_CLEANUP_INTERVAL", "300"))
+IDEMPOTENCY_CLEANUP_BATCH = int(os.getenv("IDEMPOTENCY_CLEANUP_BATCH", "10000"))
+
+# (username, key) -> (request hash, response), kept until the key expires
+recent_keys = TTLCache(IDEMPOTENCY_CACHE_SIZE, IDEMPOTENCY_KEY_TTL)
+
+
+def request_hash(request: BaseModel) -> str:
+    return hashlib.sha256(request.model_dump_json().encode()).hexdigest()
+
+
+def _replay(stored_hash: str, response: dict, hash_: str) -> dict:
+    if stored_hash != hash_:
+        raise HTTPException(
+            status_code=422,
+            detail="The Idempotency-Key was already used for a different request",
+        )
+    return response
+
+
+def cached_response(username: str, key: str, hash_: str) -> Optional[dict]:
+    """
+    Function that returns the response stored for a key if it is in the cache.
+
+    :param username: str: The user making the request, keys are per user.
+    :param key: str: The Idempotency-Key header.
+    :param hash_: str: The request_hash() of the request.
+    :return: Optional[dict]: The stored response, None if the key is not cached.
+    :raises HTTPException: 422 if the key was used for a different request.
+    """
+    cached = recent_keys.get((username, key))
+    if cached is None:
+        return None
+    return _replay(cached[0], cached[1], hash_)
+
+
+def stored_response(record: Optional[IdempotencyKey], hash_: str) -> Optional[dict]:
+    """
+    Function that returns the response stored in a row of the table, and caches it.
+
+    :param record: Optional[IdempotencyKey]: The row of the key, if any.
+    :param hash_: str: The request_hash() of the request.
+    :return: Optional[dict]: The stored response, None if there is none.
+    :raises HTTPException: 422 if the key was used for a different request.
+    """
+    if record is None or is_expired(record):
+        return None
+    response = json.loads(record.response)
+    remember(record, response)
+    return _replay(record.request_hash, response, hash_)
+
+
+def is_expired(record: IdempotencyKey) -> bool:
+    # An expired row that was not cleaned up yet is deleted by the request reusing the
+    # key, the new row replaces it when the transfer commits
+    return record.expires_at <= datetime.utcnow()
+
+
+def find_response(db: Session, username: str, key: str, hash_: str) -> Optional[dict]:
+    """
+    Function that returns the response of a previous request with the same key,
+    from the cache or else from the table.
+
+    :param db: Session: The database session of the request.
+    :param username: str: The user making the request.
+    :param key: str: The Idempotency-Key header.
+    :param hash_: str: The request_hash() of the request.
+    :return: Optional[dict]: The stored response, None if the key is new.
+    :raises HTTPException: 422 if the key was used for a different request.
+    """
+    response = cached_response(username, key, hash_)
+    if response is not None:
+        return response
+    record = db.get(IdempotencyKey, (username, key))
+    if record is not None and is_expired(record):
+        db.delete(record)
+    return stored_response(record, hash_)
+
+
+async def find_response_async(
+    db: AsyncSession, username: str, key: str, hash_: str
+) -> Optional[dict]:
+    """
+    Function that does the same as find_response() on an AsyncSession.
+    """
+    response = cached_response(username, key, hash_)
+    if response is not None:
+        return response
+    record = await db.get(IdempotencyKey, (username, key))
+    if record is not None and is_expired(record):
+        await db.delete(record)
+    return stored_response(record, hash_)
+
+
+def remember(record: IdempotencyKey, response: dict):
+    ttl = (record.expires_at - datetime.utcnow()).total_seconds()
+    recent_keys.set(
+        (record.username, record.idempotency_key),
+        (record.request_hash, response),
+        ttl=ttl,
+    )
+
+
+def new_record(username: str, key: str, hash_: str) -> IdempotencyKey:
+    now = datetime.utcnow()
+    return IdempotencyKey(
+        username=username,
+        idempotency_key=key,
+        request_hash=hash_,
+        created_at=now,
+        expires_at=now + timedelta(seconds=IDEMPOTENCY_KEY_TTL),
+    )
+
+
+def transaction_response(transaction: Transaction) -> dict:
+    return {
+        "from_account": transaction.from_account,
+        "to_account": transaction.to_account,
+        "amount": transaction.amount,
+        "timestamp": transaction.timestamp.isoformat(),
+    }
+
+
+def add_to_transaction(db: Session, record: IdempotencyKey, transaction: Transaction):
+    """
+    Function that stores the response of a transfer in its key, to be committed
+    together with the transfer. The timestamp of the transaction has to be set.
+    """
+    record.response = json.dumps(transaction_response(transaction))
+    db.add(record)
+
+
+def delete_expired(db: Session, batch_size: int = IDEMPOTENCY_CLEANUP_BATCH) -> int:
+    """
+    Function that deletes the expired keys, batch_size rows per statement and
+    transaction so the cleanup never holds many row locks at once.
+
+    :param db: Session: The database session.
+    :param batch_size: int: The number of rows deleted per transaction.
+    :return: int: The number of deleted keys.
+    """
+    deleted = 0
+    while True:
+        expired = (
+            select(IdempotencyKey.username, IdempotencyKey.idempotency_key)
+            .where(IdempotencyKey.expires_at <= datetime.utcnow())
+            .limit(batch_size)
+        )
+        result = db.execute(
+            delete(IdempotencyKey)
+            .where(
+                tuple_(IdempotencyKey.username, IdempotencyKey.idempotency_key).in_(
+                    expired
+                )
+            )
+            .execution_options(synchronize_session=False)
+        )
+        db.commit()
+        deleted += result.rowcount
+        if result.rowcount < batch_size:
+            return deleted
+
+
+def _delete_expired_keys() -> int:
+    with SessionLocal() as db:
+        return delete_expired(db)
+
+
+async def cleanup_expired_keys(interval: float = IDEMPOTENCY_CLEANUP_INTERVAL):
+    """
+    Background task deleting the expired keys every interval seconds, started by the
+    lifespan of the app.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await run_in_threadpool(_delete_expired_keys)
+        except Exception:  # pylint: disable=broad-except
+            # e.g. the database is restarting, the next run deletes them
+            logger.exception("Deleting the expired idempotency keys failed")
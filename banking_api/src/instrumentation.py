@@ -0,0 +1,149 @@
+"""
+Module for the per request instrumentation of the API.
+
+InstrumentationMiddleware times every request and the SQLAlchemy cursor hooks count the
+queries of the request and the time spent executing them. Code paths worth telling apart
+(e.g. bcrypt or the token verification) are timed with timed(). The results are added to
+the response as a Server-Timing header and aggregated per route in request_metrics,
+which GET /metrics exposes in the Prometheus format.
+
+The overhead is two perf_counter() calls per query and a few per request.
+"""
+
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from metrics import RequestMetrics
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.datastructures import MutableHeaders
+
+request_metrics = RequestMetrics()
+
+
+class RequestStats:
+    """Measurements of the request being handled"""
+
+    __slots__ = ("queries", "db_seconds", "timings")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        # name -> seconds, filled by timed()
+        self.timings = {}
+
+    def server_timing(self, total_seconds: float) -> str:
+        metrics = [
+            f"app;dur={total_seconds * 1000:.3f}",
+            f'db;dur={self.db_seconds * 1000:.3f};desc="{self.queries} queries"',
+        ]
+        metrics += [
+            f"{name};dur={seconds * 1000:.3f}" for name, seconds in self.timings.items()
+        ]
+        return ", ".join(metrics)
+
+
+# The sync routes run in a threadpool with a copy of the context, the stats object itself
+# is shared so what they record is seen by the middleware
+_current_request: ContextVar[Optional[RequestStats]] = ContextVar(
+    "current_request", default=None
+)
+
+
+def current_request_stats() -> Optional[RequestStats]:
+    """Returns the stats of the request being handled, None outside of a request"""
+    return _current_request.get()
+
+
+@contextmanager
+def timed(name: str):
+    """
+    Context manager adding the time spent in its block to the Server-Timing header of the
+    current request, under the given name.
+    """
+    stats = _current_request.get()
+    if stats is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.timings[name] = stats.timings.get(name, 0.0) + (
+            time.perf_counter() - start
+        )
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and _current_request.get() is not None:
+        context._query_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current_request.get()
+    started = getattr(context, "_query_started", None)
+    if stats is None or started is None:
+        return
+    stats.queries += 1
+    stats.db_seconds += time.perf_counter() - started
+
+
+def instrument_engines():
+    """
+    Function that installs the query hooks on all the engines, the sync engine of
+    postgres_interface as well as the one behind the async engine.
+    Queries running outside of a request are ignored.
+    """
+    if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+
+
+class InstrumentationMiddleware:
+    """
+    ASGI middleware measuring the requests.
+    It is a plain ASGI middleware rather than a BaseHTTPMiddleware, which would run the
+    route in a separate task and buffer streaming responses.
+    """
+
+    def __init__(self, app, metrics: RequestMetrics = request_metrics):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = _current_request.set(stats)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = MutableHeaders(scope=message)
+                headers.append(
+                    "Server-Timing", stats.server_timing(time.perf_counter() - start)
+                )
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current_request.reset(token)
+            # The router stores the matched route in the scope, the requests not
+            # matching any route share one series
+            route = scope.get("route")
+            self.metrics.observe(
+                scope["method"],
+                getattr(route, "path", "unmatched"),
+                status,
+                time.perf_counter() - start,
+                stats.queries,
+                stats.db_seconds,
+            )
@@ -1,22 +1,76 @@
+import asyncio
+from contextlib import asynccontextmanager, suppress
+
+import diagnostics
+import idempotency
+import partitions
 import uvicorn
 from fastapi import FastAPI
-from postgres_interface import Base, create_tables, engine, fill_tables
-from routes import accounts, auth, customers, transactions, users
+from instrumentation import InstrumentationMiddleware, instrument_engines
+from postgres_interface import (
+    USE_ASYNC_DB,
+    Base,
+    create_tables,
+    engine,
+    env_flag,
+    fill_tables,
+)
+from replicas import replica_set
+from routes import accounts, auth, customers, metrics, transactions, users
+from starlette.concurrency import run_in_threadpool
+from transfer_queue import group_commit
+
+# Per request latency, query count and database time, see instrumentation.py
+REQUEST_METRICS = env_flag("REQUEST_METRICS", default=True)
 
 Base.metadata.create_all(bind=engine)
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Background cleanup of the expired idempotency keys
+    cleanup = asyncio.create_task(idempotency.cleanup_expired_keys())
+    # Creation of the upcoming monthly partitions of the transactions on postgres
+    partitioning = asyncio.create_task(partitions.maintain_partitions())
+    # Health and lag checks of the read replicas, if any
+    replica_checks = asyncio.create_task(replica_set.monitor())
+    yield
+    for task in (cleanup, partitioning, replica_checks):
+        task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task
+    # Commits the transfers still in the group commit queue
+    await run_in_threadpool(group_commit.shutdown)
+
+
 app = FastAPI(
+    lifespan=lifespan,
     title="Banking API",
     description="An internal banking API for managing accounts and transactions",
     version="1.0.0",
     docs_url="/docs",
     redoc_url="/redoc",
 )
+# Slow queries, repeated queries and sampled profiles, see diagnostics.py. It can be
+# switched on at runtime, so the middleware is always installed
+diagnostics.instrument_engines()
+app.add_middleware(diagnostics.DiagnosticsMiddleware)
+if REQUEST_METRICS:
+    instrument_engines()
+    app.add_middleware(InstrumentationMiddleware)
+if USE_ASYNC_DB:
+    # Routes are matched in registration order, so the async routes shadow the sync ones
+    app.include_router(accounts.async_router, prefix="/accounts", tags=["Accounts"])
+    app.include_router(
+        transactions.async_router, prefix="/transactions", tags=["Transactions"]
+    )
+    app.include_router(customers.async_router, prefix="/customers", tags=["Customers"])
 app.include_router(accounts.router, prefix="/accounts", tags=["Accounts"])
 app.include_router(transactions.router, prefix="/transactions", tags=["Transactions"])
 app.include_router(customers.router, prefix="/customers", tags=["Customers"])
 app.include_router(users.router, prefix="/users", tags=["Users"])
 app.include_router(auth.router, prefix="/auth", tags=["Authentication"])
+app.include_router(metrics.router, prefix="/metrics", tags=["Metrics"])
 
 
 @app.get("/", tags=["Health Check"])
@@ -0,0 +1,300 @@
+"""
+Module for collecting runtime metrics of the API.
+"""
+
+import time
+from bisect import bisect_left
+from threading import Lock
+
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+# Bucket upper bounds (in seconds) used for the connection pool wait times
+POOL_WAIT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+# Bucket upper bounds (in seconds) used for the request durations
+REQUEST_DURATION_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+
+
+class Histogram:
+    """
+    Histogram with fixed buckets, the counts are cumulative like in Prometheus.
+    Observing a value is O(log(buckets)) and thread safe.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._lock = Lock()
+
+    def observe(self, value: float):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def snapshot(self) -> dict:
+        """
+        Returns the cumulative count per bucket upper bound ("+Inf" included),
+        the total count and the sum of the observed values.
+        """
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(self.buckets + ("+Inf",), counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        return {"buckets": buckets, "count": cumulative, "sum": total}
+
+
+class _PoolMetricsMixin:
+    """
+    Records how long callers wait for a connection and how many of them time out.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_time = Histogram(POOL_WAIT_BUCKETS)
+        self.timeouts = 0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            self.wait_time.observe(time.perf_counter() - start)
+
+    def recreate(self):
+        # The engine recreates its pool on dispose(), the metrics carry over
+        pool = super().recreate()
+        pool.wait_time = self.wait_time
+        pool.timeouts = self.timeouts
+        return pool
+
+
+class InstrumentedQueuePool(_PoolMetricsMixin, QueuePool):
+    """QueuePool recording connection wait times, used by the sync engine"""
+
+
+class InstrumentedAsyncQueuePool(_PoolMetricsMixin, AsyncAdaptedQueuePool):
+    """AsyncAdaptedQueuePool recording connection wait times, used by the async engine"""
+
+
+def pool_stats(pool) -> dict:
+    """
+    Function that returns the current state of a connection pool.
+
+    :param pool: The pool of an engine, e.g. engine.pool
+    :return: dict: The pool configuration, usage counts and wait time histogram.
+    """
+    stats = {
+        "pool_size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "idle": pool.checkedin(),
+        # overflow() is negative while the pool has not opened pool_size connections yet
+        "overflow": max(pool.overflow(), 0),
+        "max_overflow": pool._max_overflow,
+    }
+    if isinstance(pool, _PoolMetricsMixin):
+        stats["timeouts"] = pool.timeouts
+        stats["wait_time_seconds"] = pool.wait_time.snapshot()
+    return stats
+
+
+class RequestMetrics:
+    """
+    Per route request counts and durations, with the number of queries and the time spent
+    in the database. Routes are the path templates (e.g. /accounts/{account_id}/balance/)
+    so the number of series stays bounded.
+    """
+
+    def __init__(self):
+        # (method, route) -> {"duration": Histogram, "statuses": {status: count},
+        #                     "queries": int, "db_seconds": float}
+        self._routes = {}
+        self._lock = Lock()
+
+    def observe(
+        self,
+        method: str,
+        route: str,
+        status: int,
+        duration: float,
+        queries: int,
+        db_seconds: float,
+    ):
+        key = (method, route)
+        with self._lock:
+            entry = self._routes.get(key)
+            if entry is None:
+                entry = self._routes[key] = {
+                    "duration": Histogram(REQUEST_DURATION_BUCKETS),
+                    "statuses": {},
+                    "queries": 0,
+                    "db_seconds": 0.0,
+                }
+            entry["statuses"][status] = entry["statuses"].get(status, 0) + 1
+            entry["queries"] += queries
+            entry["db_seconds"] += db_seconds
+        entry["duration"].observe(duration)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            routes = {
+                key: {**entry, "statuses": dict(entry["statuses"])}
+                for key, entry in self._routes.items()
+            }
+        return {
+            key: {**entry, "duration": entry["duration"].snapshot()}
+            for key, entry in routes.items()
+        }
+
+    def clear(self):
+        with self._lock:
+            self._routes.clear()
+
+
+def _labels(**labels) -> str:
+    escaped = (
+        (
+            name,
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for name, value in labels.items()
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def _histogram_lines(name: str, snapshot: dict, **labels) -> list:
+    lines = [
+        f"{name}_bucket{_labels(**labels, le=bound)} {count}"
+        for bound, count in snapshot["buckets"].items()
+    ]
+    lines.append(f"{name}_sum{_labels(**labels)} {snapshot['sum']}")
+    lines.append(f"{name}_count{_labels(**labels)} {snapshot['count']}")
+    return lines
+
+
+def prometheus_text(
+    requests: dict, pools: dict, balance_cache: dict, replicas: list = ()
+) -> str:
+    """
+    Function that renders metrics in the Prometheus text exposition format.
+
+    :param requests: dict: RequestMetrics.snapshot()
+    :param pools: dict: pool_stats() of every pool, by pool name.
+    :param balance_cache: dict: The stats of the balance cache.
+    :param replicas: list: The stats of the read replicas.
+    :return: str: The metrics, one sample per line.
+    """
+    lines = [
+        "# HELP http_request_duration_seconds Time to handle a request.",
+        "# TYPE http_request_duration_seconds histogram",
+    ]
+    for (method, route), entry in requests.items():
+        lines += _histogram_lines(
+            "http_request_duration_seconds",
+            entry["duration"],
+            method=method,
+            route=route,
+        )
+    lines += [
+        "# HELP http_requests_total Handled requests by status code.",
+        "# TYPE http_requests_total counter",
+    ]
+    for (method, route), entry in requests.items():
+        for status, count in sorted(entry["statuses"].items()):
+            lines.append(
+                f"http_requests_total{_labels(method=method, route=route, status=status)}"
+                f" {count}"
+            )
+    lines += [
+        "# HELP db_queries_total SQL statements executed by the requests.",
+        "# TYPE db_queries_total counter",
+    ]
+    for (method, route), entry in requests.items():
+        lines.append(
+            f"db_queries_total{_labels(method=method, route=route)} {entry['queries']}"
+        )
+    lines += [
+        "# HELP db_query_duration_seconds_total Time the requests spent executing SQL.",
+        "# TYPE db_query_duration_seconds_total counter",
+    ]
+    for (method, route), entry in requests.items():
+        lines.append(
+            f"db_query_duration_seconds_total{_labels(method=method, route=route)}"
+            f" {entry['db_seconds']}"
+        )
+
+    for name, kind, key in (
+        ("db_pool_size", "gauge", "pool_size"),
+        ("db_pool_checked_out", "gauge", "checked_out"),
+        ("db_pool_idle", "gauge", "idle"),
+        ("db_pool_overflow", "gauge", "overflow"),
+        ("db_pool_timeouts_total", "counter", "timeouts"),
+    ):
+        lines.append(f"# TYPE {name} {kind}")
+        for pool, stats in pools.items():
+            if key in stats:
+                lines.append(f"{name}{_labels(pool=pool)} {stats[key]}")
+    lines.append("# TYPE db_pool_wait_seconds histogram")
+    for pool, stats in pools.items():
+        if "wait_time_seconds" in stats:
+            lines += _histogram_lines(
+                "db_pool_wait_seconds", stats["wait_time_seconds"], pool=pool
+            )
+
+    for key in ("hits", "misses", "evictions", "invalidations"):
+        if key in balance_cache:
+            lines.append(f"# TYPE balance_cache_{key}_total counter")
+            lines.append(f"balance_cache_{key}_total {balance_cache[key]}")
+
+    if replicas:
+        lines.append("# TYPE db_replica_healthy gauge")
+        for replica in replicas:
+            lines.append(
+                f"db_replica_healthy{_labels(replica=replica['name'])}"
+                f" {int(replica['healthy'])}"
+            )
+        lines.append("# TYPE db_replica_lag_seconds gauge")
+        for replica in replicas:
+            if replica["lag_seconds"] is not None:
+                lag = replica["lag_seconds"]
+                lines.append(
+                    f"db_replica_lag_seconds{_labels(replica=replica['name'])}"
+                    f" {'+Inf' if lag == float('inf') else lag}"
+                )
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,155 @@
+"""
+Module for the schema migrations of the database.
+Migrations are applied once, in order, and recorded in the schema_migrations table,
+so running them on every start only applies the ones a database is missing.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import text
+
+
+def _transactions_account_indexes(conn):
+    # Both sides of the transfer history query are served by an index range scan that
+    # already returns the rows in the order of the history
+    conn.execute(
+        text(
+            """
+            CREATE INDEX IF NOT EXISTS ix_transactions_from_account_timestamp
+            ON transactions (from_account, timestamp DESC, id DESC)
+            """
+        )
+    )
+    conn.execute(
+        text(
+            """
+            CREATE INDEX IF NOT EXISTS ix_transactions_to_account_timestamp
+            ON transactions (to_account, timestamp DESC, id DESC)
+            """
+        )
+    )
+
+
+def _idempotency_keys(conn):
+    # The primary key is the unique index a replayed request is found with, the expiry
+    # index serves the bulk cleanup of the expired keys
+    conn.execute(
+        text(
+            """
+            CREATE TABLE IF NOT EXISTS idempotency_keys (
+                username VARCHAR(255) NOT NULL,
+                idempotency_key VARCHAR(255) NOT NULL,
+                request_hash VARCHAR(64) NOT NULL,
+                response TEXT NOT NULL,
+                created_at TIMESTAMP NOT NULL,
+                expires_at TIMESTAMP NOT NULL,
+                PRIMARY KEY (username, idempotency_key)
+            )
+            """
+        )
+    )
+    conn.execute(
+        text(
+            """
+            CREATE INDEX IF NOT EXISTS ix_idempotency_keys_expires_at
+            ON idempotency_keys (expires_at)
+            """
+        )
+    )
+
+
+def _account_statements(conn):
+    # The primary key serves the statement of an account, which reads a range of
+    # period_start for one account and period
+    conn.execute(
+        text(
+            """
+            CREATE TABLE IF NOT EXISTS account_statements (
+                account_id INTEGER NOT NULL
+                    REFERENCES accounts (id) ON DELETE CASCADE,
+                period VARCHAR(5) NOT NULL,
+                period_start TIMESTAMP NOT NULL,
+                credit_count INTEGER NOT NULL DEFAULT 0,
+                credit_total DOUBLE PRECISION NOT NULL DEFAULT 0,
+                credit_min DOUBLE PRECISION,
+                credit_max DOUBLE PRECISION,
+                debit_count INTEGER NOT NULL DEFAULT 0,
+                debit_total DOUBLE PRECISION NOT NULL DEFAULT 0,
+                debit_min DOUBLE PRECISION,
+                debit_max DOUBLE PRECISION,
+                PRIMARY KEY (account_id, period, period_start)
+            )
+            """
+        )
+    )
+    # The statements of the existing transactions. Imported here because the models
+    # import postgres_interface, which imports this module
+    from statements import rebuild_statements  # pylint: disable=import-outside-toplevel
+
+    rebuild_statements(conn)
+
+
+def _partition_transactions(conn):
+    # Only on postgres, see partitions.py
+    from partitions import (  # pylint: disable=import-outside-toplevel
+        partition_transactions,
+    )
+
+    partition_transactions(conn)
+
+
+# (version, migration) pairs, a migration is a function taking the connection.
+# New migrations are appended at the end, applied ones must not be changed.
+MIGRATIONS = [
+    ("0001_transactions_account_indexes", _transactions_account_indexes),
+    ("0002_idempotency_keys", _idempotency_keys),
+    ("0003_account_statements", _account_statements),
+    ("0004_partition_transactions", _partition_transactions),
+]
+
+
+def run_migrations(engine) -> list:
+    """
+    Function that applies the migrations missing from the database.
+    Every migration runs in its own transaction together with its schema_migrations row.
+    On postgres an advisory lock makes concurrent callers (e.g. several workers starting
+    at once) wait for each other instead of applying the same migration twice.
+
+    :param engine: The engine of the database to migrate.
+    :return: list: The versions of the migrations that were applied.
+    """
+    applied = []
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                """
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version VARCHAR(255) PRIMARY KEY,
+                    applied_at TIMESTAMP NOT NULL
+                )
+                """
+            )
+        )
+
+    for version, migration in MIGRATIONS:
+        with engine.begin() as conn:
+            if conn.dialect.name == "postgresql":
+                conn.execute(
+                    text("SELECT pg_advisory_xact_lock(hashtext('migrations'))")
+                )
+            done = conn.execute(
+                text("SELECT 1 FROM schema_migrations WHERE version = :version"),
+                {"version": version},
+            ).first()
+            if done:
+                continue
+            migration(conn)
+            conn.execute(
+                text(
+                    "INSERT INTO schema_migrations (version, applied_at) "
+                    "VALUES (:version, :applied_at)"
+                ),
+                {"version": version, "applied_at": datetime.utcnow()},
+            )
+            applied.append(version)
+    return applied
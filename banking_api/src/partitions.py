@@ -0,0 +1,345 @@
+"""
+Module for the monthly partitions of the transactions table on postgres.
+
+The 0004 migration turns transactions into a table partitioned by range of timestamp,
+with one partition per month (transactions_YYYY_MM) and a default partition
+(transactions_default) for the rows outside of them. Queries with a date range, like the
+transfer history, only scan the partitions of that range, and every partition has its
+own small indexes and is vacuumed on its own.
+
+The partitions of the next PARTITION_MONTHS_AHEAD months are created by the migration
+and then every PARTITION_CHECK_INTERVAL seconds by a background task of the app. Old
+partitions are detached and exported to gzipped CSV files with the archive command:
+
+    python banking_api/src/partitions.py archive --before 2024-01-01 --output-dir archive
+    python banking_api/src/partitions.py ensure --months-ahead 6
+
+On other databases the table is not partitioned and these functions do nothing.
+"""
+
+import argparse
+import asyncio
+import gzip
+import logging
+import os
+import re
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from postgres_interface import engine
+from sqlalchemy import text
+from starlette.concurrency import run_in_threadpool
+
+logger = logging.getLogger(__name__)
+
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", "3"))
+PARTITION_CHECK_INTERVAL = float(os.getenv("PARTITION_CHECK_INTERVAL", "3600"))
+# Detaching a partition locks the whole table, while it waits for the running
+# transactions the new ones queue behind it, so it gives up after this long
+PARTITION_LOCK_TIMEOUT = os.getenv("PARTITION_LOCK_TIMEOUT", "5s")
+
+DEFAULT_PARTITION = "transactions_default"
+ARCHIVE_COLUMNS = ("id", "from_account", "to_account", "amount", "timestamp")
+
+_BOUNDS = re.compile(r"FROM \('([^']+)'\) TO \('([^']+)'\)")
+
+
+def month_start(value: datetime) -> datetime:
+    return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def add_months(month: datetime, months: int) -> datetime:
+    index = month.year * 12 + month.month - 1 + months
+    return month.replace(year=index // 12, month=index % 12 + 1)
+
+
+def partition_name(month: datetime) -> str:
+    return f"transactions_{month:%Y_%m}"
+
+
+def is_partitioned(conn) -> bool:
+    if conn.dialect.name != "postgresql":
+        return False
+    relkind = conn.execute(
+        text("SELECT relkind FROM pg_class WHERE oid = to_regclass('transactions')")
+    ).scalar()
+    return relkind == "p"
+
+
+def list_partitions(conn) -> List[Tuple[str, datetime, datetime]]:
+    """
+    Function that returns the monthly partitions of the transactions table.
+
+    :param conn: Connection: The database connection.
+    :return: List[Tuple[str, datetime, datetime]]: The name and the [lower, upper)
+        bounds of every partition, oldest first. The default partition is left out.
+    """
+    rows = conn.execute(
+        text(
+            """
+            SELECT child.relname, pg_get_expr(child.relpartbound, child.oid)
+            FROM pg_inherits
+            JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+            WHERE pg_inherits.inhparent = 'transactions'::regclass
+            """
+        )
+    )
+    partitions = []
+    for name, bound in rows:
+        match = _BOUNDS.search(bound)
+        if match:
+            lower, upper = (datetime.fromisoformat(value) for value in match.groups())
+            partitions.append((name, lower, upper))
+    return sorted(partitions, key=lambda partition: partition[1])
+
+
+def ensure_partitions(conn, start: datetime, end: datetime) -> List[str]:
+    """
+    Function that creates the monthly partitions missing between two dates.
+    The rows of the default partition falling in a new partition are moved into it,
+    and the partition is attached rather than created on the table, which does not
+    block the reads and writes of the other partitions.
+
+    :param conn: Connection: The database connection, in a transaction.
+    :param start: datetime: The partition of this month is the first one created.
+    :param end: datetime: The partitions are created up to this date, excluded.
+    :return: List[str]: The names of the created partitions.
+    """
+    if not is_partitioned(conn):
+        return []
+    # Concurrent callers (e.g. every worker of the app) wait for each other
+    conn.execute(
+        text("SELECT pg_advisory_xact_lock(hashtext('transactions_partitions'))")
+    )
+    existing = {name for name, _, _ in list_partitions(conn)}
+
+    created = []
+    month = month_start(start)
+    while month < end:
+        name = partition_name(month)
+        upper = add_months(month, 1)
+        if name not in existing:
+            bounds = {"lower": month, "upper": upper}
+            conn.execute(
+                text(f"CREATE TABLE {name} (LIKE transactions INCLUDING DEFAULTS)")
+            )
+            conn.execute(
+                text(
+                    f"""
+                    WITH moved AS (
+                        DELETE FROM {DEFAULT_PARTITION}
+                        WHERE timestamp >= :lower AND timestamp < :upper
+                        RETURNING *
+                    )
+                    INSERT INTO {name} SELECT * FROM moved
+                    """
+                ),
+                bounds,
+            )
+            conn.execute(
+                text(
+                    f"ALTER TABLE transactions ATTACH PARTITION {name} "
+                    f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{upper:%Y-%m-%d}')"
+                )
+            )
+            created.append(name)
+        month = upper
+    return created
+
+
+def ensure_future_partitions(
+    conn, months_ahead: int = PARTITION_MONTHS_AHEAD
+) -> List[str]:
+    """
+    Function that creates the partitions of the current month and of the next
+    months_ahead months if they are missing.
+    """
+    now = month_start(datetime.utcnow())
+    return ensure_partitions(conn, now, add_months(now, months_ahead + 1))
+
+
+def partition_transactions(conn):
+    """
+    Function that turns the transactions table into a partitioned table, used by the
+    0004 migration. The rows are copied into the monthly partitions, from the month of
+    the oldest transaction to PARTITION_MONTHS_AHEAD months from now. The primary key
+    becomes (id, timestamp) because the key of a partitioned table has to include the
+    partition key, the ids keep coming from the same sequence.
+
+    :param conn: Connection: The database connection, in a transaction.
+    """
+    if conn.dialect.name != "postgresql" or is_partitioned(conn):
+        return
+    sequence = conn.execute(
+        text("SELECT pg_get_serial_sequence('transactions', 'id')")
+    ).scalar()
+    oldest = conn.execute(text("SELECT min(timestamp) FROM transactions")).scalar()
+
+    conn.execute(text("ALTER TABLE transactions RENAME TO transactions_unpartitioned"))
+    conn.execute(
+        text(
+            """
+            CREATE TABLE transactions (
+                LIKE transactions_unpartitioned INCLUDING DEFAULTS
+            ) PARTITION BY RANGE (timestamp)
+            """
+        )
+    )
+    conn.execute(text("ALTER TABLE transactions ALTER COLUMN timestamp SET NOT NULL"))
+    conn.execute(
+        text(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF transactions DEFAULT")
+    )
+    now = month_start(datetime.utcnow())
+    ensure_partitions(
+        conn,
+        min(oldest, now) if oldest else now,
+        add_months(now, PARTITION_MONTHS_AHEAD + 1),
+    )
+    conn.execute(
+        text(
+            """
+            INSERT INTO transactions (id, from_account, to_account, amount, timestamp)
+            SELECT id, from_account, to_account, amount,
+                COALESCE(timestamp, CURRENT_TIMESTAMP)
+            FROM transactions_unpartitioned
+            """
+        )
+    )
+    if sequence:
+        conn.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY transactions.id"))
+    conn.execute(text("DROP TABLE transactions_unpartitioned"))
+
+    # Created after the copy, which is faster than maintaining them during it
+    conn.execute(text("ALTER TABLE transactions ADD PRIMARY KEY (id, timestamp)"))
+    for column in ("from_account", "to_account"):
+        conn.execute(
+            text(
+                f"ALTER TABLE transactions ADD FOREIGN KEY ({column}) "
+                "REFERENCES accounts (id) ON DELETE CASCADE"
+            )
+        )
+    conn.execute(text("CREATE INDEX ix_transactions_id ON transactions (id)"))
+    for column in ("from_account", "to_account"):
+        conn.execute(
+            text(
+                f"CREATE INDEX ix_transactions_{column}_timestamp "
+                f"ON transactions ({column}, timestamp DESC, id DESC)"
+            )
+        )
+
+
+def archive_partitions(
+    engine, before: datetime, output_dir: str, keep: bool = False
+) -> List[dict]:
+    """
+    Function that archives the monthly partitions ending before a date. Each partition
+    is detached from the table, so its rows leave the history, exported to
+    output_dir/<partition>.csv.gz and then dropped. A partition that failed to export
+    stays detached and can be exported again or attached back.
+
+    :param engine: The engine of the database.
+    :param before: datetime: The partitions ending at or before this date are archived.
+    :param output_dir: str: The directory of the archive files.
+    :param keep: bool: Keep the detached tables instead of dropping them.
+    :return: List[dict]: The partition, number of rows and file of every archive.
+    """
+    with engine.connect() as conn:
+        if not is_partitioned(conn):
+            raise ValueError("The transactions table is not partitioned")
+        partitions = [
+            name for name, _, upper in list_partitions(conn) if upper <= before
+        ]
+
+    os.makedirs(output_dir, exist_ok=True)
+    archives = []
+    for name in partitions:
+        with engine.begin() as conn:
+            conn.execute(
+                text("SELECT set_config('lock_timeout', :timeout, true)"),
+                {"timeout": PARTITION_LOCK_TIMEOUT},
+            )
+            conn.execute(text(f"ALTER TABLE transactions DETACH PARTITION {name}"))
+        path = os.path.join(output_dir, f"{name}.csv.gz")
+        rows = _export_table(engine, name, path)
+        if not keep:
+            with engine.begin() as conn:
+                conn.execute(text(f"DROP TABLE {name}"))
+        archives.append({"partition": name, "rows": rows, "path": path})
+        logger.info("Archived %d transactions of %s to %s", rows, name, path)
+    return archives
+
+
+def _export_table(engine, name: str, path: str) -> int:
+    # Written next to the final file and renamed once complete, so a file with the
+    # final name is always a whole partition
+    partial = path + ".partial"
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(f"SELECT count(*) FROM {name}")
+        rows = cursor.fetchone()[0]
+        with gzip.open(partial, "wt", newline="") as archive:
+            cursor.copy_expert(
+                f"COPY (SELECT {', '.join(ARCHIVE_COLUMNS)} FROM {name} "
+                "ORDER BY timestamp, id) TO STDOUT WITH (FORMAT csv, HEADER)",
+                archive,
+            )
+        connection.commit()
+    finally:
+        connection.close()
+    os.replace(partial, path)
+    return rows
+
+
+def _ensure_future_partitions() -> List[str]:
+    with engine.begin() as conn:
+        return ensure_future_partitions(conn)
+
+
+async def maintain_partitions(interval: float = PARTITION_CHECK_INTERVAL):
+    """
+    Background task creating the upcoming partitions every interval seconds, started by
+    the lifespan of the app.
+    """
+    while True:
+        try:
+            created = await run_in_threadpool(_ensure_future_partitions)
+            if created:
+                logger.info("Created the partitions %s", ", ".join(created))
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Creating the transactions partitions failed")
+        await asyncio.sleep(interval)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Transactions partitions")
+    commands = parser.add_subparsers(dest="command", required=True)
+    ensure = commands.add_parser("ensure", help="create the upcoming partitions")
+    ensure.add_argument("--months-ahead", type=int, default=PARTITION_MONTHS_AHEAD)
+    archive = commands.add_parser("archive", help="detach and export old partitions")
+    archive.add_argument(
+        "--before",
+        type=datetime.fromisoformat,
+        required=True,
+        help="archive the partitions ending at or before this date",
+    )
+    archive.add_argument("--output-dir", required=True)
+    archive.add_argument("--keep", action="store_true", help="keep the detached tables")
+    args = parser.parse_args(argv)
+
+    if args.command == "ensure":
+        with engine.begin() as conn:
+            created = ensure_future_partitions(conn, args.months_ahead)
+        print(f"Created {len(created)} partitions: {', '.join(created)}")
+    else:
+        for archived in archive_partitions(
+            engine, args.before, args.output_dir, args.keep
+        ):
+            print(
+                f"{archived['partition']}: {archived['rows']} transactions "
+                f"archived to {archived['path']}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -3,7 +3,17 @@
 from datetime import datetime
 
 from postgres_interface import Base
-from sqlalchemy import Column, DateTime, Float, ForeignKey, Integer, String
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Float,
+    ForeignKey,
+    Index,
+    Integer,
+    PrimaryKeyConstraint,
+    String,
+    Text,
+)
 from sqlalchemy.orm import relationship
 
 
@@ -35,6 +45,8 @@ class Transaction(Base):
     """
     Model for the transactions table
     we assume that the from_account and to_account are foreign keys to the accounts
+    On postgres the 0004 migration partitions it by month, with (id, timestamp) as the
+    primary key, see partitions.py
     """
 
     __tablename__ = "transactions"
@@ -44,6 +56,22 @@ class Transaction(Base):
     amount = Column(Float, nullable=False)
     timestamp = Column(DateTime, default=datetime.utcnow)
 
+    # Also created by the 0001 migration for databases that predate them
+    __table_args__ = (
+        Index(
+            "ix_transactions_from_account_timestamp",
+            from_account,
+            timestamp.desc(),
+            id.desc(),
+        ),
+        Index(
+            "ix_transactions_to_account_timestamp",
+            to_account,
+            timestamp.desc(),
+            id.desc(),
+        ),
+    )
+
 
 class Users(Base):
     """
@@ -54,3 +82,45 @@ class Users(Base):
     __tablename__ = "users"
     username = Column(String, primary_key=True, index=True)
     hashed_password = Column(String, nullable=False)
+
+
+class IdempotencyKey(Base):
+    """
+    Model for the idempotency_keys table
+    It stores the response of a transfer made with an Idempotency-Key header, per user,
+    until the key expires. Also created by the 0002 migration.
+    """
+
+    __tablename__ = "idempotency_keys"
+    username = Column(String(255), primary_key=True)
+    idempotency_key = Column(String(255), primary_key=True)
+    # sha256 of the request body, a key can not be reused for a different request
+    request_hash = Column(String(64), nullable=False)
+    response = Column(Text, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+
+class AccountStatement(Base):
+    """
+    Model for the account_statements table
+    It holds the totals received (credit) and sent (debit) by an account per day and
+    per month, kept up to date by the transfers, see statements.py.
+    Also created by the 0003 migration.
+    """
+
+    __tablename__ = "account_statements"
+    account_id = Column(Integer, ForeignKey("accounts.id", ondelete="CASCADE"))
+    # "day" or "month"
+    period = Column(String(5))
+    period_start = Column(DateTime)
+    credit_count = Column(Integer, nullable=False, default=0)
+    credit_total = Column(Float, nullable=False, default=0.0)
+    credit_min = Column(Float)
+    credit_max = Column(Float)
+    debit_count = Column(Integer, nullable=False, default=0)
+    debit_total = Column(Float, nullable=False, default=0.0)
+    debit_min = Column(Float)
+    debit_max = Column(Float)
+
+    __table_args__ = (PrimaryKeyConstraint(account_id, period, period_start),)
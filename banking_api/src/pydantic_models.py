@@ -3,9 +3,11 @@ Pydantic models for request and response bodies.
 Requests sent to the API are validated using these models.
 """
 
+import json
 from datetime import datetime
+from typing import List, Literal, Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, TypeAdapter
 
 
 class AccountCreate(BaseModel):
@@ -31,6 +33,31 @@ class TransactionResponse(BaseModel):
     timestamp: datetime
 
 
+class HistoryPage(BaseModel):
+    history: List[TransactionResponse]
+    next_cursor: Optional[str] = None
+
+
+class BatchTransferRequest(BaseModel):
+    transfers: List[TransferRequest] = Field(min_length=1)
+    mode: Literal["all_or_nothing", "best_effort"] = "all_or_nothing"
+
+
+class BatchTransferItemResult(BaseModel):
+    index: int
+    success: bool
+    transaction: Optional[TransactionResponse] = None
+    error: Optional[str] = None
+
+
+class BatchTransferResponse(BaseModel):
+    mode: Literal["all_or_nothing", "best_effort"]
+    committed: bool
+    succeeded: int
+    failed: int
+    results: List[BatchTransferItemResult]
+
+
 class CustomerCreate(BaseModel):
     id: int
     name: str
@@ -39,3 +66,62 @@ class CustomerCreate(BaseModel):
 class UsersCreate(BaseModel):
     username: str
     password: str
+
+
+class BulkCustomersResponse(BaseModel):
+    created: int
+    ids: List[int]
+
+
+class BulkAccountsResponse(BaseModel):
+    created: int
+    accounts: List[AccountResponse]
+
+
+class StatementTotals(BaseModel):
+    count: int
+    total: float
+    min: Optional[float] = None
+    max: Optional[float] = None
+
+
+class StatementPeriod(BaseModel):
+    period_start: datetime
+    credit: StatementTotals
+    debit: StatementTotals
+    net: float
+
+
+class StatementResponse(BaseModel):
+    account_id: int
+    period: Literal["day", "month"]
+    periods: List[StatementPeriod]
+
+
+class DiagnosticsSettings(BaseModel):
+    enabled: bool = False
+    slow_query_ms: float = Field(100.0, ge=0)
+    explain: bool = True
+    repeated_query_threshold: int = Field(2, ge=2)
+    profile_sample_rate: float = Field(0.0, ge=0, le=1)
+
+
+class DiagnosticsSettingsUpdate(BaseModel):
+    enabled: Optional[bool] = None
+    slow_query_ms: Optional[float] = Field(None, ge=0)
+    explain: Optional[bool] = None
+    repeated_query_threshold: Optional[int] = Field(None, ge=2)
+    profile_sample_rate: Optional[float] = Field(None, ge=0, le=1)
+
+
+def parse_bulk_items(body: bytes, content_type: str, model) -> list:
+    """
+    Parses the body of a bulk request, either a JSON array or NDJSON (one JSON object per
+    line, with the application/x-ndjson content type), into a list of model objects.
+    Raises a pydantic ValidationError if an item is invalid.
+    """
+    if content_type.split(";")[0].strip() == "application/x-ndjson":
+        items = [json.loads(line) for line in body.splitlines() if line.strip()]
+    else:
+        items = json.loads(body)
+    return TypeAdapter(List[model]).validate_python(items)
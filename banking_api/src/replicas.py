@@ -0,0 +1,258 @@
+"""
+Module for the routing of the reads to the read replicas.
+
+With READ_REPLICA_URLS set (comma separated database URLs), the read-only routes (balance,
+transfer history and statement) get their session from get_read_db. It is a
+RoutingSession: its SELECT statements go to one of the healthy replicas, everything else
+(writes, SELECT ... FOR UPDATE, flushes) goes to the primary, and once it wrote it reads
+from the primary too. A request with the X-Read-Your-Writes: true header reads from the
+primary, to see the writes it just made. The banking operations keep using the sessions
+of get_db, which only know the primary.
+
+The replicas are checked every REPLICA_CHECK_INTERVAL seconds. A replica that can't be
+reached or replays the primary more than REPLICA_MAX_LAG seconds late is ejected until a
+check finds it healthy again. Without a healthy replica the reads go to the primary.
+"""
+
+import asyncio
+import itertools
+import logging
+import os
+from typing import List, Optional
+
+from fastapi import Header
+from metrics import InstrumentedAsyncQueuePool, InstrumentedQueuePool
+from postgres_interface import (
+    POOL_SETTINGS,
+    SessionLocal,
+    async_url,
+    engine,
+    get_async_engine,
+    get_async_sessionmaker,
+)
+from sqlalchemy import Select, create_engine, make_url, text
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+logger = logging.getLogger(__name__)
+
+READ_REPLICA_URLS = [
+    url.strip() for url in os.getenv("READ_REPLICA_URLS", "").split(",") if url.strip()
+]
+REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG", "5"))
+REPLICA_CHECK_INTERVAL = float(os.getenv("REPLICA_CHECK_INTERVAL", "5"))
+
+# Keys of RoutingSession.info: the replica the session reads from (None for the
+# primary) and whether it has to use the primary
+_REPLICA = "replica"
+_PRIMARY = "read_from_primary"
+
+
+class Replica:
+    """
+    A read replica with its engines and the result of its last health check.
+    It is only used once a check found it healthy.
+    """
+
+    def __init__(self, url: str):
+        self.url = url
+        self.name = make_url(url).render_as_string(hide_password=True)
+        self.engine = create_engine(
+            url, poolclass=InstrumentedQueuePool, **POOL_SETTINGS
+        )
+        self.healthy = False
+        self.lag: Optional[float] = None
+        self.error: Optional[str] = None
+        self._async_engine = None
+
+    @property
+    def async_engine(self):
+        # Created on first use like the async engine of the primary
+        if self._async_engine is None:
+            self._async_engine = create_async_engine(
+                async_url(self.url),
+                poolclass=InstrumentedAsyncQueuePool,
+                **POOL_SETTINGS,
+            )
+        return self._async_engine
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "healthy": self.healthy,
+            "lag_seconds": self.lag,
+            "error": self.error,
+        }
+
+
+def measure_lag(conn) -> float:
+    """
+    Function that returns how many seconds a replica is behind its primary.
+    A replica that replayed everything it received is not behind, however long ago the
+    last write on the primary was. Databases without replication are never behind.
+
+    :param conn: Connection: A connection to the replica.
+    :return: float: The lag in seconds, inf if the replica never replayed anything.
+    """
+    if conn.dialect.name != "postgresql":
+        return 0.0
+    lag = conn.execute(
+        text(
+            """
+            SELECT CASE
+                WHEN NOT pg_is_in_recovery()
+                    OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+            END
+            """
+        )
+    ).scalar()
+    return float("inf") if lag is None else float(lag)
+
+
+class ReplicaSet:
+    """
+    The read replicas, picked in turn among the healthy ones.
+    """
+
+    def __init__(self, urls: List[str], max_lag: float = REPLICA_MAX_LAG):
+        self.replicas = [Replica(url) for url in urls]
+        self.max_lag = max_lag
+        self._turn = itertools.count()
+
+    def __bool__(self):
+        return bool(self.replicas)
+
+    def pick(self) -> Optional[Replica]:
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            return None
+        return healthy[next(self._turn) % len(healthy)]
+
+    def check(self):
+        """
+        Checks every replica and ejects the unreachable and lagging ones.
+        """
+        for replica in self.replicas:
+            was_healthy = replica.healthy
+            try:
+                with replica.engine.connect() as conn:
+                    replica.lag = measure_lag(conn)
+                replica.error = None
+                replica.healthy = replica.lag <= self.max_lag
+            except Exception as error:  # pylint: disable=broad-except
+                replica.lag = None
+                replica.error = str(error)
+                replica.healthy = False
+            if was_healthy and not replica.healthy:
+                logger.warning(
+                    "Replica %s ejected, lag %s, error %s",
+                    replica.name,
+                    replica.lag,
+                    replica.error,
+                )
+            elif replica.healthy and not was_healthy:
+                logger.info("Replica %s is healthy", replica.name)
+
+    async def monitor(self, interval: float = REPLICA_CHECK_INTERVAL):
+        """
+        Background task checking the replicas every interval seconds, started by the
+        lifespan of the app. The first check runs right away.
+        """
+        if not self.replicas:
+            return
+        while True:
+            await run_in_threadpool(self.check)
+            await asyncio.sleep(interval)
+
+    def stats(self) -> list:
+        return [replica.stats() for replica in self.replicas]
+
+
+replica_set = ReplicaSet(READ_REPLICA_URLS)
+
+
+def _is_read(clause) -> bool:
+    return isinstance(clause, Select) and clause._for_update_arg is None
+
+
+class RoutingSession(Session):
+    """
+    Session sending its reads to a replica of replica_set and the rest to its bind,
+    the primary. It reads from the same replica for as long as it is open.
+    With use_async, it is the sync session of an AsyncSession and routes to the async
+    engines of the replicas.
+    """
+
+    def __init__(self, *args, replica_set: ReplicaSet, use_async=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.replica_set = replica_set
+        self.use_async = use_async
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self._flushing or not _is_read(clause):
+            # Later reads have to see what the session wrote
+            self.info[_PRIMARY] = True
+        elif not self.info.get(_PRIMARY):
+            if _REPLICA not in self.info:
+                self.info[_REPLICA] = self.replica_set.pick()
+            replica = self.info[_REPLICA]
+            if replica is not None:
+                if self.use_async:
+                    return replica.async_engine.sync_engine
+                return replica.engine
+        return super().get_bind(mapper=mapper, clause=clause, **kwargs)
+
+
+def read_from_replica(db) -> bool:
+    """
+    Function that returns whether a session read from a replica, whose data can be up
+    to REPLICA_MAX_LAG seconds old.
+    """
+    return db.info.get(_REPLICA) is not None
+
+
+def read_session(read_your_writes: bool = False) -> Session:
+    """
+    Function that returns a session for reads, see the module docstring.
+
+    :param read_your_writes: bool: Read from the primary anyway.
+    :return: Session: A RoutingSession, or a session of the primary without replicas.
+    """
+    if not replica_set:
+        return SessionLocal()
+    db = RoutingSession(bind=engine, autoflush=False, replica_set=replica_set)
+    db.info[_PRIMARY] = read_your_writes
+    return db
+
+
+def get_read_db(x_read_your_writes: bool = Header(False)):
+    """
+    Dependency returning the session of a read-only route.
+    """
+    db = read_session(x_read_your_writes)
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+async def get_async_read_db(x_read_your_writes: bool = Header(False)):
+    """
+    Dependency returning the AsyncSession of a read-only route.
+    """
+    if not replica_set:
+        async with get_async_sessionmaker()() as db:
+            yield db
+        return
+    async with AsyncSession(
+        bind=get_async_engine(),
+        sync_session_class=RoutingSession,
+        autoflush=False,
+        expire_on_commit=False,
+        replica_set=replica_set,
+        use_async=True,
+    ) as db:
+        db.info[_PRIMARY] = x_read_your_writes
+        yield db
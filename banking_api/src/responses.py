@@ -0,0 +1,73 @@
+"""
+Module for the fast JSON responses of the routes returning lists of transactions or
+accounts: the history pages, the batch transfer results, the bulk created accounts and
+the statements.
+
+FastAPI validates what a route returns against its response_model, turns it into JSON
+compatible Python objects and then encodes those with json.dumps, which is most of the
+CPU time of a large response. With FAST_JSON set, these routes return a FastJSONResponse
+instead, which validates the payload with the TypeAdapter of the response model and
+serializes it to JSON bytes in the same pass, in pydantic-core. With
+FAST_JSON_VALIDATE=false the payload, built by the route itself, is only serialized, so
+it has to have every field of the response model.
+
+benchmarks/json_responses.py compares the three modes.
+"""
+
+from functools import lru_cache
+from typing import Any, Optional
+
+import pydantic_core
+from fastapi.responses import Response
+from postgres_interface import env_flag
+from pydantic import TypeAdapter
+
+FAST_JSON = env_flag("FAST_JSON")
+FAST_JSON_VALIDATE = env_flag("FAST_JSON_VALIDATE", default=True)
+
+
+@lru_cache(maxsize=None)
+def type_adapter(model) -> TypeAdapter:
+    # Building an adapter compiles its schema, so there is one per model
+    return TypeAdapter(model)
+
+
+class FastJSONResponse(Response):
+    """
+    JSON response serialized by pydantic-core, validated against model unless
+    validate is False (FAST_JSON_VALIDATE by default).
+    """
+
+    media_type = "application/json"
+
+    def __init__(
+        self,
+        content: Any,
+        model: Optional[Any] = None,
+        validate: Optional[bool] = None,
+        **kwargs,
+    ):
+        # Set before Response.__init__, which renders the content
+        self.model = model
+        self.validate = FAST_JSON_VALIDATE if validate is None else validate
+        super().__init__(content, **kwargs)
+
+    def render(self, content: Any) -> bytes:
+        if self.model is not None and self.validate:
+            adapter = type_adapter(self.model)
+            return adapter.dump_json(adapter.validate_python(content))
+        return pydantic_core.to_json(content)
+
+
+def json_response(content: Any, model: Any):
+    """
+    Function that returns the payload of a route, as a FastJSONResponse with FAST_JSON
+    and as is otherwise, for FastAPI to validate and encode it.
+
+    :param content: Any: The payload, made of dicts, lists and JSON compatible values.
+    :param model: The response model of the route.
+    :return: The payload or the response.
+    """
+    if FAST_JSON:
+        return FastJSONResponse(content, model)
+    return content
@@ -1,12 +1,57 @@
-from banking_operations import create_account
-from fastapi import APIRouter, Depends, HTTPException
-from postgres_interface import get_db
+import json
+from datetime import datetime
+from typing import Literal, Optional
+
+import banking_operations_async as async_ops
+from balance_cache import balances
+from banking_operations import (
+    BULK_CHUNK_SIZE,
+    create_account,
+    create_accounts_bulk,
+    get_account_statement,
+)
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.exceptions import RequestValidationError
+from postgres_interface import get_async_db, get_db
 from postgres_models import Account
-from pydantic_models import AccountCreate, AccountResponse
+from pydantic import ValidationError
+from pydantic_models import (
+    AccountCreate,
+    AccountResponse,
+    BulkAccountsResponse,
+    StatementResponse,
+    parse_bulk_items,
+)
+from replicas import get_async_read_db, get_read_db, read_from_replica
+from responses import json_response
 from security import get_current_user
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
 router = APIRouter()
+# Async versions of the routes, registered in front of the sync ones when USE_ASYNC_DB is set
+async_router = APIRouter()
+
+BULK_REQUEST_BODY = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "application/json": {
+                "schema": {
+                    "type": "array",
+                    "items": {"$ref": "#/components/schemas/AccountCreate"},
+                }
+            },
+            "application/x-ndjson": {
+                "schema": {
+                    "type": "string",
+                    "description": "One AccountCreate per line",
+                }
+            },
+        },
+    }
+}
 
 
 @router.post("/create/", response_model=AccountResponse)
@@ -19,13 +64,155 @@ def create_new_account(
     return {"account_id": new_account.id, "balance": new_account.balance}
 
 
+@router.post(
+    "/bulk", response_model=BulkAccountsResponse, openapi_extra=BULK_REQUEST_BODY
+)
+async def create_accounts(
+    request: Request,
+    chunk_size: int = Query(BULK_CHUNK_SIZE, ge=1, le=100_000),
+    db: Session = Depends(get_db),
+    current_user: str = Depends(get_current_user),
+):
+    """
+    Route for creating many accounts at once, from a JSON array or NDJSON body.
+    The accounts are inserted and committed chunk_size at a time. If a chunk fails,
+    the previous chunks stay created and their ids are returned with a 409.
+    """
+    try:
+        accounts = parse_bulk_items(
+            await request.body(), request.headers.get("content-type", ""), AccountCreate
+        )
+    except json.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Invalid JSON body")
+    except ValidationError as error:
+        raise RequestValidationError(error.errors())
+
+    created = await run_in_threadpool(create_accounts_bulk, db, accounts, chunk_size)
+    if isinstance(created, dict):
+        raise HTTPException(status_code=409, detail=created)
+    return json_response(
+        {
+            "created": len(created),
+            "accounts": [
+                {"account_id": account_id, "balance": balance}
+                for account_id, balance in created
+            ],
+        },
+        BulkAccountsResponse,
+    )
+
+
 @router.get("/{account_id}/balance/", response_model=AccountResponse)
 def get_balance(
     account_id: int,
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
+    current_user: str = Depends(get_current_user),
+):
+    balance = balances.get(account_id)
+    if balance is None:
+        token = balances.start_read()
+        account = db.query(Account).filter(Account.id == account_id).first()
+        if not account:
+            raise HTTPException(status_code=404, detail="Account not found")
+        balance = account.balance
+        # A replica can be behind the invalidations of the cache, so only balances
+        # read from the primary are cached
+        if not read_from_replica(db):
+            balances.set(account_id, balance, token)
+    return {"account_id": account_id, "balance": balance}
+
+
+def statement_response(account_id: int, period: str, rows: list) -> dict:
+    """
+    Builds the response of the statement routes from the AccountStatement rows.
+    """
+    periods = []
+    for row in rows:
+        periods.append(
+            {
+                "period_start": row.period_start,
+                "credit": {
+                    "count": row.credit_count,
+                    "total": row.credit_total,
+                    "min": row.credit_min,
+                    "max": row.credit_max,
+                },
+                "debit": {
+                    "count": row.debit_count,
+                    "total": row.debit_total,
+                    "min": row.debit_min,
+                    "max": row.debit_max,
+                },
+                "net": row.credit_total - row.debit_total,
+            }
+        )
+    return {"account_id": account_id, "period": period, "periods": periods}
+
+
+@router.get("/{account_id}/statement", response_model=StatementResponse)
+def get_statement(
+    account_id: int,
+    period: Literal["day", "month"] = "month",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    db: Session = Depends(get_read_db),
+    current_user: str = Depends(get_current_user),
+):
+    """
+    Route for the totals received (credit) and sent (debit) by an account per day or per
+    month: count, total, smallest and largest amount. Only the periods with transfers
+    are returned, start and end select the periods starting in [start, end).
+    """
+    rows = get_account_statement(db, account_id, period, start, end)
+    if not rows and not db.get(Account, account_id):
+        raise HTTPException(status_code=404, detail="Account not found")
+    return json_response(
+        statement_response(account_id, period, rows), StatementResponse
+    )
+
+
+@async_router.post("/create/", response_model=AccountResponse)
+async def create_new_account_async(
+    account: AccountCreate,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: str = Depends(get_current_user),
+):
+    new_account = await async_ops.create_account(
+        db, account.customer_id, account.initial_deposit
+    )
+    return {"account_id": new_account.id, "balance": new_account.balance}
+
+
+@async_router.get("/{account_id}/balance/", response_model=AccountResponse)
+async def get_balance_async(
+    account_id: int,
+    db: AsyncSession = Depends(get_async_read_db),
+    current_user: str = Depends(get_current_user),
+):
+    balance = balances.get(account_id)
+    if balance is None:
+        token = balances.start_read()
+        account = await async_ops.get_account(db, account_id)
+        if not account:
+            raise HTTPException(status_code=404, detail="Account not found")
+        balance = account.balance
+        if not read_from_replica(db):
+            balances.set(account_id, balance, token)
+    return {"account_id": account_id, "balance": balance}
+
+
+@async_router.get("/{account_id}/statement", response_model=StatementResponse)
+async def get_statement_async(
+    account_id: int,
+    period: Literal["day", "month"] = "month",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    db: AsyncSession = Depends(get_async_read_db),
     current_user: str = Depends(get_current_user),
 ):
-    account = db.query(Account).filter(Account.id == account_id).first()
-    if not account:
+    rows = await async_ops.get_account_statement(db, account_id, period, start, end)
+    if not rows and not await async_ops.get_account(db, account_id):
         raise HTTPException(status_code=404, detail="Account not found")
-    return {"account_id": account.id, "balance": account.balance}
+    return json_response(
+        statement_response(account_id, period, rows), StatementResponse
+    )
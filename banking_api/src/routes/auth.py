@@ -4,7 +4,7 @@ from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordRequestForm
 from postgres_interface import get_db
 from postgres_models import Users
-from security import create_access_token, verify_password
+from security import create_access_token, verify_user_password
 from sqlalchemy.orm import Session
 
 router = APIRouter()
@@ -15,7 +15,9 @@ def login_user(
     form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)
 ):
     user = db.query(Users).filter(Users.username == form_data.username).first()
-    if not user or not verify_password(form_data.password, user.hashed_password):
+    if not user or not verify_user_password(
+        user.username, form_data.password, user.hashed_password
+    ):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid credentials",
@@ -1,11 +1,40 @@
-from banking_operations import create_customer
-from fastapi import APIRouter, Depends
-from postgres_interface import get_db
-from pydantic_models import CustomerCreate
+import json
+
+import banking_operations_async as async_ops
+from banking_operations import BULK_CHUNK_SIZE, create_customer, create_customers_bulk
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.exceptions import RequestValidationError
+from postgres_interface import get_async_db, get_db
+from pydantic import ValidationError
+from pydantic_models import BulkCustomersResponse, CustomerCreate, parse_bulk_items
 from security import get_current_user
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
 router = APIRouter()
+# Async versions of the routes, registered in front of the sync ones when USE_ASYNC_DB is set
+async_router = APIRouter()
+
+BULK_REQUEST_BODY = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "application/json": {
+                "schema": {
+                    "type": "array",
+                    "items": {"$ref": "#/components/schemas/CustomerCreate"},
+                }
+            },
+            "application/x-ndjson": {
+                "schema": {
+                    "type": "string",
+                    "description": "One CustomerCreate per line",
+                }
+            },
+        },
+    }
+}
 
 
 @router.post("/create/", response_model=CustomerCreate)
@@ -16,3 +45,43 @@ def create_new_customer(
 ):
     new_customer = create_customer(db, customer.id, customer.name)
     return new_customer
+
+
+@router.post(
+    "/bulk", response_model=BulkCustomersResponse, openapi_extra=BULK_REQUEST_BODY
+)
+async def create_customers(
+    request: Request,
+    chunk_size: int = Query(BULK_CHUNK_SIZE, ge=1, le=100_000),
+    db: Session = Depends(get_db),
+    current_user: str = Depends(get_current_user),
+):
+    """
+    Route for creating many customers at once, from a JSON array or NDJSON body.
+    The customers are inserted and committed chunk_size at a time. If a chunk fails,
+    the previous chunks stay created and their ids are returned with a 409.
+    """
+    try:
+        customers = parse_bulk_items(
+            await request.body(),
+            request.headers.get("content-type", ""),
+            CustomerCreate,
+        )
+    except json.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Invalid JSON body")
+    except ValidationError as error:
+        raise RequestValidationError(error.errors())
+
+    ids = await run_in_threadpool(create_customers_bulk, db, customers, chunk_size)
+    if isinstance(ids, dict):
+        raise HTTPException(status_code=409, detail=ids)
+    return {"created": len(ids), "ids": ids}
+
+
+@async_router.post("/create/", response_model=CustomerCreate)
+async def create_new_customer_async(
+    customer: CustomerCreate,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: str = Depends(get_current_user),
+):
+    return await async_ops.create_customer(db, customer.id, customer.name)
@@ -0,0 +1,94 @@
+import diagnostics
+from balance_cache import balances
+from fastapi import APIRouter, Depends
+from fastapi.responses import PlainTextResponse
+from instrumentation import request_metrics
+from metrics import pool_stats, prometheus_text
+from postgres_interface import engine, get_async_engine
+from pydantic_models import DiagnosticsSettings, DiagnosticsSettingsUpdate
+from replicas import replica_set
+from security import get_current_user
+from transfer_queue import group_commit
+
+router = APIRouter()
+
+
+def _pools() -> dict:
+    pools = {"sync": pool_stats(engine.pool)}
+    if get_async_engine.cache_info().currsize:
+        pools["async"] = pool_stats(get_async_engine().pool)
+    for replica in replica_set.replicas:
+        pools[f"replica {replica.name}"] = pool_stats(replica.engine.pool)
+    return pools
+
+
+@router.get("")
+def prometheus_metrics():
+    """
+    Route for the metrics in the Prometheus text format: latency histogram, status codes,
+    query count and database time per route, plus the connection pools and the balance
+    cache.
+    """
+    return PlainTextResponse(
+        prometheus_text(
+            request_metrics.snapshot(), _pools(), balances.stats(), replica_set.stats()
+        ),
+        media_type="text/plain; version=0.0.4",
+    )
+
+
+@router.get("/db-pool")
+def db_pool_metrics():
+    """
+    Route for the state of the database connection pools: checked out, idle and overflow
+    connections, timeouts and the histogram of the time spent waiting for a connection.
+    The async pool is only reported once the async engine has been created.
+    """
+    return _pools()
+
+
+@router.get("/replicas")
+def replicas_metrics():
+    """
+    Route for the state of the read replicas: whether they are used, their lag in seconds
+    and the error of their last health check.
+    """
+    return replica_set.stats()
+
+
+@router.get("/balance-cache")
+def balance_cache_metrics():
+    """
+    Route for the counters of the balance cache: hits, misses, evictions and
+    invalidations.
+    """
+    return balances.stats()
+
+
+@router.get("/transfer-queue")
+def transfer_queue_metrics():
+    """
+    Route for the counters of the group commit queue of the transfers: transfers waiting,
+    batches committed and their average size.
+    """
+    return group_commit.stats()
+
+
+@router.get("/diagnostics")
+def diagnostics_findings():
+    """
+    Route for the diagnostics settings and their latest findings: slow queries with their
+    plan, statements repeated within a request and the profiles written.
+    """
+    return diagnostics.findings()
+
+
+@router.patch("/diagnostics", response_model=DiagnosticsSettings)
+def update_diagnostics(
+    update: DiagnosticsSettingsUpdate, current_user: str = Depends(get_current_user)
+):
+    """
+    Route to change the diagnostics settings without restarting the API.
+    Only the worker handling the request is changed.
+    """
+    return diagnostics.update_settings(update)
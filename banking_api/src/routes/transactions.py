@@ -1,35 +1,109 @@
-from banking_operations import get_transfer_history, transfer_money
-from fastapi import APIRouter, Depends, HTTPException
-from postgres_interface import get_db
+import asyncio
+import base64
+import csv
+import io
+import json
+from datetime import datetime
+from typing import Literal, Optional, Tuple
+
+import banking_operations_async as async_ops
+import idempotency
+from banking_operations import (
+    get_transfer_history,
+    iter_transfer_history,
+    transfer_money,
+    transfer_money_batch,
+)
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response
+from fastapi.responses import StreamingResponse
+from postgres_interface import get_async_db, get_db
 from postgres_models import Transaction
-from pydantic_models import TransactionResponse, TransferRequest
+from pydantic_models import (
+    BatchTransferRequest,
+    BatchTransferResponse,
+    HistoryPage,
+    TransactionResponse,
+    TransferRequest,
+)
+from replicas import get_async_read_db, get_read_db, read_session
+from responses import json_response
 from security import get_current_user
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
+from transfer_queue import TRANSFER_GROUP_COMMIT, group_commit
 
 router = APIRouter()
+# Async versions of the routes, registered in front of the sync ones when USE_ASYNC_DB is set
+async_router = APIRouter()
+
+EXPORT_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+EXPORT_COLUMNS = ("id", "from_account", "to_account", "amount", "timestamp")
+
+
+REPLAYED_HEADER = "Idempotent-Replayed"
 
 
 @router.post("/transfer/", response_model=TransactionResponse)
 def transfer_funds(
     transfer: TransferRequest,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None, max_length=255),
     db: Session = Depends(get_db),
     current_user: str = Depends(get_current_user),
 ) -> Transaction:
     """
     This endpoint is used for transferring funds between two accounts.
     The transfer request object is passed as a parameter to this endpoint.
+    With an Idempotency-Key header, retrying the request returns the response of the
+    first one instead of transferring again.
 
     args
     ----
     transfer: TransferRequest
         The transfer request object
+    idempotency_key: Optional[str]
+        A key unique to this transfer, chosen by the client (e.g. a UUID)
 
     returns
     -------
     Transaction
         The transaction
     """
-    transaction = transfer_money(db, transfer)
+    record = None
+    if idempotency_key:
+        hash_ = idempotency.request_hash(transfer)
+        replayed = idempotency.find_response(db, current_user, idempotency_key, hash_)
+        if replayed is not None:
+            response.headers[REPLAYED_HEADER] = "true"
+            return replayed
+        record = idempotency.new_record(current_user, idempotency_key, hash_)
+
+    if TRANSFER_GROUP_COMMIT and record is None:
+        # Committed together with the other queued transfers, see transfer_queue.py.
+        # The transfers with an idempotency key are committed on their own.
+        transaction = group_commit.submit(transfer).result()
+        if not transaction:
+            raise HTTPException(
+                status_code=400,
+                detail="An error occurred while processing the transaction",
+            )
+        return transaction
+
+    try:
+        transaction = transfer_money(db, transfer, idempotency_key=record)
+    except IntegrityError:
+        if record is None:
+            raise
+        # A concurrent request with the same key committed first
+        db.rollback()
+        replayed = idempotency.find_response(db, current_user, idempotency_key, hash_)
+        if replayed is None:
+            raise
+        response.headers[REPLAYED_HEADER] = "true"
+        return replayed
+    if record is not None and isinstance(transaction, Transaction):
+        idempotency.remember(record, idempotency.transaction_response(transaction))
     if not transaction:
         raise HTTPException(
             status_code=400, detail="An error occurred while processing the transaction"
@@ -37,28 +111,83 @@ def transfer_funds(
     return transaction
 
 
-@router.get("/history/{account_id}", response_model=dict)
-def transfer_history(
-    account_id: int,
+@router.post("/transfer/batch", response_model=BatchTransferResponse)
+def transfer_funds_batch(
+    batch: BatchTransferRequest,
     db: Session = Depends(get_db),
     current_user: str = Depends(get_current_user),
 ):
     """
-    This endpoint is used for getting the transfer history for a given account.
+    This endpoint is used for applying many transfers in a single database transaction.
+    In "all_or_nothing" mode nothing is committed if any transfer fails, in "best_effort"
+    mode the failing transfers are skipped and the rest are committed.
 
     args
     ----
-    account_id: int
-        The account id for which the transfer history needs to be retrieved
+    batch: BatchTransferRequest
+        The list of transfers and the batch mode
 
     returns
     -------
-    List[Transaction]
-        The list of transactions for the given account
+    BatchTransferResponse
+        Whether the batch was committed and the result of each transfer
+    """
+    committed, results = transfer_money_batch(
+        db, batch.transfers, atomic=batch.mode == "all_or_nothing"
+    )
+    succeeded = sum(1 for result in results if result["success"])
+    return json_response(
+        {
+            "mode": batch.mode,
+            "committed": committed,
+            "succeeded": succeeded,
+            "failed": len(results) - succeeded,
+            "results": results,
+        },
+        BatchTransferResponse,
+    )
+
+
+class HistoryQuery:
+    """
+    Query parameters of the history routes.
+    The cursor is the opaque "next_cursor" of the previous page.
+    """
+
+    def __init__(
+        self,
+        limit: int = Query(100, ge=1, le=1000),
+        after: Optional[str] = None,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+    ):
+        self.limit = limit
+        self.after = decode_cursor(after) if after else None
+        self.start = start
+        self.end = end
+
+
+def encode_cursor(transaction: Transaction) -> str:
+    value = f"{transaction.timestamp.isoformat()}|{transaction.id}"
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        timestamp, transaction_id = base64.urlsafe_b64decode(cursor).decode().split("|")
+        return datetime.fromisoformat(timestamp), int(transaction_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def history_page(history: list, limit: int) -> dict:
+    """
+    Builds the response of the history routes.
+    The history is queried with limit + 1 rows to know if there is a next page.
     """
-    history = get_transfer_history(db, account_id)
+    page = history[:limit]
     result = []
-    for transaction in history:
+    for transaction in page:
         result.append(
             {
                 "from_account": transaction.from_account,
@@ -67,4 +196,167 @@ def transfer_history(
                 "timestamp": transaction.timestamp,
             }
         )
-    return {"history": result}
+    next_cursor = encode_cursor(page[-1]) if len(history) > limit else None
+    return {"history": result, "next_cursor": next_cursor}
+
+
+@router.get("/history/{account_id}", response_model=dict)
+def transfer_history(
+    account_id: int,
+    query: HistoryQuery = Depends(),
+    db: Session = Depends(get_read_db),
+    current_user: str = Depends(get_current_user),
+):
+    """
+    This endpoint is used for getting the transfer history for a given account,
+    newest first and one page at a time.
+
+    args
+    ----
+    account_id: int
+        The account id for which the transfer history needs to be retrieved
+    query: HistoryQuery
+        The page size (limit), the cursor of the previous page (after) and
+        the optional date range (start, end)
+
+    returns
+    -------
+    dict
+        The page of transactions ("history") and the cursor of the next page
+        ("next_cursor"), which is null on the last page
+    """
+    history = get_transfer_history(
+        db, account_id, query.limit + 1, query.after, query.start, query.end
+    )
+    return json_response(history_page(history, query.limit), HistoryPage)
+
+
+@router.get("/history/{account_id}/export")
+def export_transfer_history(
+    account_id: int,
+    format: Literal["ndjson", "csv"] = "ndjson",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    x_read_your_writes: bool = Header(False),
+    current_user: str = Depends(get_current_user),
+):
+    """
+    This endpoint is used for exporting the whole transfer history of an account,
+    newest first, as NDJSON (one JSON object per line) or CSV.
+    The rows are streamed as they are read from the database, so the memory used
+    stays flat however large the history is.
+
+    args
+    ----
+    account_id: int
+        The account id for which the transfer history needs to be exported
+    format: str
+        "ndjson" or "csv"
+    start: Optional[datetime]
+        Only export transactions made at or after this time
+    end: Optional[datetime]
+        Only export transactions made before this time
+    """
+    return StreamingResponse(
+        stream_transfer_history(account_id, format, start, end, x_read_your_writes),
+        media_type=EXPORT_MEDIA_TYPES[format],
+    )
+
+
+def stream_transfer_history(
+    account_id, file_format, start, end, read_your_writes=False, chunk_rows=1000
+):
+    # The session of get_read_db is closed before the response is streamed, so the
+    # export uses its own session for as long as the client is reading
+    db = read_session(read_your_writes)
+    try:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if file_format == "csv":
+            writer.writerow(EXPORT_COLUMNS)
+        rows = 0
+        for transaction in iter_transfer_history(db, account_id, start, end):
+            values = (
+                transaction.id,
+                transaction.from_account,
+                transaction.to_account,
+                transaction.amount,
+                transaction.timestamp.isoformat(),
+            )
+            if file_format == "csv":
+                writer.writerow(values)
+            else:
+                buffer.write(json.dumps(dict(zip(EXPORT_COLUMNS, values))) + "\n")
+            rows += 1
+            if rows % chunk_rows == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+    finally:
+        db.close()
+
+
+@async_router.post("/transfer/", response_model=TransactionResponse)
+async def transfer_funds_async(
+    transfer: TransferRequest,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None, max_length=255),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: str = Depends(get_current_user),
+) -> Transaction:
+    record = None
+    if idempotency_key:
+        hash_ = idempotency.request_hash(transfer)
+        replayed = await idempotency.find_response_async(
+            db, current_user, idempotency_key, hash_
+        )
+        if replayed is not None:
+            response.headers[REPLAYED_HEADER] = "true"
+            return replayed
+        record = idempotency.new_record(current_user, idempotency_key, hash_)
+
+    if TRANSFER_GROUP_COMMIT and record is None:
+        transaction = await asyncio.wrap_future(group_commit.submit(transfer))
+        if not transaction:
+            raise HTTPException(
+                status_code=400,
+                detail="An error occurred while processing the transaction",
+            )
+        return transaction
+
+    try:
+        transaction = await async_ops.transfer_money(
+            db, transfer, idempotency_key=record
+        )
+    except IntegrityError:
+        if record is None:
+            raise
+        await db.rollback()
+        replayed = await idempotency.find_response_async(
+            db, current_user, idempotency_key, hash_
+        )
+        if replayed is None:
+            raise
+        response.headers[REPLAYED_HEADER] = "true"
+        return replayed
+    if record is not None and isinstance(transaction, Transaction):
+        idempotency.remember(record, idempotency.transaction_response(transaction))
+    if not transaction:
+        raise HTTPException(
+            status_code=400, detail="An error occurred while processing the transaction"
+        )
+    return transaction
+
+
+@async_router.get("/history/{account_id}", response_model=dict)
+async def transfer_history_async(
+    account_id: int,
+    query: HistoryQuery = Depends(),
+    db: AsyncSession = Depends(get_async_read_db),
+    current_user: str = Depends(get_current_user),
+):
+    history = await async_ops.get_transfer_history(
+        db, account_id, query.limit + 1, query.after, query.start, query.end
+    )
+    return json_response(history_page(history, query.limit), HistoryPage)
@@ -1,9 +1,19 @@
+import hashlib
+import hmac
+import secrets
+import time
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
+from functools import lru_cache
+from importlib import import_module
+from multiprocessing import get_context
 from os import getenv
 from typing import Optional
 
+from cache import TTLCache
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
+from instrumentation import timed
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 
@@ -13,6 +23,26 @@ ALGORITHM = "HS256"
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/token")
 
+# Successful password verifications are cached for PASSWORD_CACHE_TTL seconds, so repeated
+# logins of the same user skip bcrypt. PASSWORD_CACHE_SIZE=0 disables the cache.
+PASSWORD_CACHE_SIZE = int(getenv("PASSWORD_CACHE_SIZE", "1024"))
+PASSWORD_CACHE_TTL = float(getenv("PASSWORD_CACHE_TTL", "300"))
+# Number of processes running bcrypt for the logins, 0 runs it in the calling thread
+BCRYPT_WORKERS = int(getenv("BCRYPT_WORKERS", "2"))
+
+# The cache keys are HMACs with a random per process key, so the cached entries can not
+# be used to guess passwords, not even by someone reading the memory of another process
+_PASSWORD_CACHE_KEY = secrets.token_bytes(32)
+verified_passwords = TTLCache(PASSWORD_CACHE_SIZE, PASSWORD_CACHE_TTL)
+
+# Verified access tokens are cached until they expire, TOKEN_CACHE_SIZE=0 disables it
+TOKEN_CACHE_SIZE = int(getenv("TOKEN_CACHE_SIZE", "4096"))
+validated_tokens = TTLCache(TOKEN_CACHE_SIZE, ttl=0)
+# Library verifying the tokens, "jose" (python-jose) or "pyjwt" (PyJWT, it has to be
+# installed separately). benchmarks/auth_overhead.py compares them on a given machine.
+# The tokens are always created with python-jose.
+JWT_BACKEND = getenv("JWT_BACKEND", "jose")
+
 
 def hash_password(password: str) -> str:
     """
@@ -37,6 +67,51 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
 
+@lru_cache(maxsize=None)
+def _bcrypt_executor() -> ProcessPoolExecutor:
+    # Spawned rather than forked, forking a process running threads is not safe
+    return ProcessPoolExecutor(
+        max_workers=BCRYPT_WORKERS, mp_context=get_context("spawn")
+    )
+
+
+def verify_user_password(
+    username: str, plain_password: str, hashed_password: str
+) -> bool:
+    """
+    Function to verify the password of a user when logging in.
+    Successful verifications are cached, keyed by an HMAC of the username and password
+    and storing the hash they were verified against. When the hash of the user changes
+    the cached entry no longer matches and the password is verified again.
+    bcrypt itself runs in a pool of BCRYPT_WORKERS processes, so a burst of logins can't
+    starve the other requests of CPU.
+
+    :param username: str: The username.
+    :param plain_password: str: The plain text password.
+    :param hashed_password: str: The hashed password of the user.
+    :return: bool: True if the password matches, False otherwise
+    """
+
+    key = hmac.new(
+        _PASSWORD_CACHE_KEY, f"{username}\0{plain_password}".encode(), hashlib.sha256
+    ).digest()
+    if verified_passwords.get(key) == hashed_password:
+        return True
+
+    with timed("bcrypt"):
+        if BCRYPT_WORKERS > 0:
+            future = _bcrypt_executor().submit(
+                verify_password, plain_password, hashed_password
+            )
+            verified = future.result()
+        else:
+            verified = verify_password(plain_password, hashed_password)
+
+    if verified:
+        verified_passwords.set(key, hashed_password)
+    return verified
+
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     """
     Function to create an access token using JWT.
@@ -52,21 +127,58 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
 
+def _decode_jose(token: str) -> dict:
+    return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+
+
+def _decode_pyjwt(token: str) -> dict:
+    pyjwt = import_module("jwt")
+    try:
+        return pyjwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except pyjwt.PyJWTError as error:
+        raise JWTError(str(error))
+
+
+JWT_DECODERS = {"jose": _decode_jose, "pyjwt": _decode_pyjwt}
+if JWT_BACKEND not in JWT_DECODERS:
+    raise ValueError(f"Unknown JWT_BACKEND: {JWT_BACKEND}")
+
+
+def decode_access_token(token: str) -> dict:
+    """
+    Function to verify an access token and return its claims, using JWT_BACKEND.
+
+    :param token: str: The access token.
+    :return: dict: The claims of the token.
+    :raises JWTError: If the token is invalid or expired.
+    """
+
+    return JWT_DECODERS[JWT_BACKEND](token)
+
+
 def get_current_user(token: str = Depends(oauth2_scheme)):
     """
     Function to get the current user from the access token.
-    It also verifies the token.
+    It also verifies the token. Verified tokens are cached until they expire,
+    so the signature of a token is only checked on its first use.
 
     :param token: str: The access token.
     :return: str: The username of the current user.
     """
+    username = validated_tokens.get(token)
+    if username is not None:
+        return username
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        with timed("jwt"):
+            payload = decode_access_token(token)
         username: str = payload.get("sub")
         if username is None:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials"
             )
+        # Tokens without an expiry are not cached, there would be no bound on their entry
+        if isinstance(payload.get("exp"), (int, float)):
+            validated_tokens.set(token, username, ttl=payload["exp"] - time.time())
         return username
     except JWTError:
         raise HTTPException(
@@ -0,0 +1,246 @@
+"""
+Module for the per-account statements.
+
+The account_statements table holds the totals of every account per day and per month:
+the number, sum, smallest and largest amount of the money received (credit) and sent
+(debit). Every transfer adds its amount to the rows of both accounts with an upsert, in
+the same database transaction as the transfer, so a statement is never behind the
+transactions and reading one costs one row per period however many transactions the
+account has.
+
+The transfers lock both accounts before the upsert, so the statement rows of an account
+are only written by one transaction at a time and the upserts can't deadlock.
+rebuild_statements() recomputes the rows from the transactions table, for transactions
+inserted without going through the banking operations.
+"""
+
+from collections import defaultdict
+from datetime import datetime
+from typing import Iterable, Optional, Tuple
+
+from postgres_models import AccountStatement, Transaction
+from sqlalchemy import (
+    Float,
+    case,
+    cast,
+    delete,
+    func,
+    literal_column,
+    null,
+    or_,
+    select,
+    union_all,
+)
+from sqlalchemy.dialects import postgresql, sqlite
+
+PERIODS = ("day", "month")
+
+# (from_account, to_account, amount, timestamp)
+Movement = Tuple[int, int, float, datetime]
+
+INSERTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
+
+def period_start(timestamp: datetime, period: str) -> datetime:
+    start = timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+    return start.replace(day=1) if period == "month" else start
+
+
+def _empty_row() -> dict:
+    return {
+        "credit_count": 0,
+        "credit_total": 0.0,
+        "credit_min": None,
+        "credit_max": None,
+        "debit_count": 0,
+        "debit_total": 0.0,
+        "debit_min": None,
+        "debit_max": None,
+    }
+
+
+def _add(row: dict, side: str, amount: float):
+    row[f"{side}_count"] += 1
+    row[f"{side}_total"] += amount
+    if row[f"{side}_min"] is None or amount < row[f"{side}_min"]:
+        row[f"{side}_min"] = amount
+    if row[f"{side}_max"] is None or amount > row[f"{side}_max"]:
+        row[f"{side}_max"] = amount
+
+
+def statement_rows(movements: Iterable[Movement]) -> list:
+    """
+    Function that adds up transfers into one row per account and period, sorted by
+    account so the rows are locked in the same order as the accounts.
+
+    :param movements: Iterable[Movement]: The transfers, as
+        (from_account, to_account, amount, timestamp).
+    :return: list: The rows to add to the account_statements table.
+    """
+    rows = defaultdict(_empty_row)
+    for from_account, to_account, amount, timestamp in movements:
+        for period in PERIODS:
+            start = period_start(timestamp, period)
+            _add(rows[(from_account, period, start)], "debit", amount)
+            _add(rows[(to_account, period, start)], "credit", amount)
+    return [
+        {"account_id": account_id, "period": period, "period_start": start, **row}
+        for (account_id, period, start), row in sorted(rows.items())
+    ]
+
+
+def _smallest(column, excluded):
+    return case(
+        (or_(column.is_(None), excluded < column), excluded),
+        else_=column,
+    )
+
+
+def _largest(column, excluded):
+    return case(
+        (or_(column.is_(None), excluded > column), excluded),
+        else_=column,
+    )
+
+
+def statement_upsert(dialect: str, movements: Iterable[Movement]):
+    """
+    Function that builds the upsert adding transfers to the statements, for the
+    INSERT ... ON CONFLICT DO UPDATE of postgres or sqlite.
+
+    :param dialect: str: The name of the database dialect.
+    :param movements: Iterable[Movement]: The transfers.
+    :return: The statement, None if there is nothing to add.
+    """
+    rows = statement_rows(movements)
+    if not rows:
+        return None
+    if dialect not in INSERTS:
+        raise ValueError(f"Statements are not supported on {dialect}")
+    statement = INSERTS[dialect](AccountStatement).values(rows)
+    table = AccountStatement.__table__.c
+    excluded = statement.excluded
+    updates = {}
+    for side in ("credit", "debit"):
+        for name in (f"{side}_count", f"{side}_total"):
+            updates[name] = table[name] + excluded[name]
+        updates[f"{side}_min"] = _smallest(
+            table[f"{side}_min"], excluded[f"{side}_min"]
+        )
+        updates[f"{side}_max"] = _largest(table[f"{side}_max"], excluded[f"{side}_max"])
+    return statement.on_conflict_do_update(
+        index_elements=["account_id", "period", "period_start"], set_=updates
+    )
+
+
+def add_to_statements(db, movements: Iterable[Movement]):
+    """
+    Function that adds transfers to the statements of their accounts, to be committed
+    together with the transfers.
+
+    :param db: Session: The database session of the transfers.
+    :param movements: Iterable[Movement]: The transfers.
+    """
+    statement = statement_upsert(db.get_bind().dialect.name, movements)
+    if statement is not None:
+        db.execute(statement)
+
+
+def account_statement_query(
+    account_id: int,
+    period: str,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+):
+    """
+    Function that builds the query for the statement of an account, oldest period first.
+
+    :param account_id: int: The account id.
+    :param period: str: "day" or "month".
+    :param start: Optional[datetime]: Only return the periods starting at or after it.
+    :param end: Optional[datetime]: Only return the periods starting before it.
+    :return: Select: The select statement for the AccountStatement rows.
+    """
+    statement = select(AccountStatement).where(
+        AccountStatement.account_id == account_id, AccountStatement.period == period
+    )
+    if start is not None:
+        statement = statement.where(AccountStatement.period_start >= start)
+    if end is not None:
+        statement = statement.where(AccountStatement.period_start < end)
+    return statement.order_by(AccountStatement.period_start)
+
+
+def _period_start_sql(dialect: str, period: str, column):
+    # A literal rather than a bound parameter, so the expression of the SELECT and of
+    # the GROUP BY are the same
+    if dialect == "postgresql":
+        return func.date_trunc(literal_column(f"'{period}'"), column)
+    # The format in which SQLAlchemy stores datetimes on sqlite, the rows have to
+    # compare equal to the ones inserted by the upserts
+    day = "%d" if period == "day" else "01"
+    return func.strftime(literal_column(f"'%Y-%m-{day} 00:00:00.000000'"), column)
+
+
+def rebuild_statements(db, account_id: Optional[int] = None):
+    """
+    Function that recomputes the statements from the transactions table, with one
+    INSERT ... SELECT per period. It is not committed.
+
+    :param db: Session or Connection: The database session or connection.
+    :param account_id: Optional[int]: Only rebuild the statements of this account.
+    """
+    dialect = db.get_bind().dialect.name if hasattr(db, "get_bind") else db.dialect.name
+    debits = select(
+        Transaction.from_account.label("account_id"),
+        Transaction.timestamp.label("timestamp"),
+        cast(null(), Float).label("credit"),
+        Transaction.amount.label("debit"),
+    )
+    credits = select(
+        Transaction.to_account,
+        Transaction.timestamp,
+        Transaction.amount,
+        cast(null(), Float),
+    )
+    clear = delete(AccountStatement)
+    if account_id is not None:
+        debits = debits.where(Transaction.from_account == account_id)
+        credits = credits.where(Transaction.to_account == account_id)
+        clear = clear.where(AccountStatement.account_id == account_id)
+    movements = union_all(debits, credits).subquery()
+    db.execute(clear)
+
+    for period in PERIODS:
+        start = _period_start_sql(dialect, period, movements.c.timestamp)
+        totals = select(
+            movements.c.account_id,
+            literal_column(f"'{period}'"),
+            start,
+            func.count(movements.c.credit),
+            func.coalesce(func.sum(movements.c.credit), 0),
+            func.min(movements.c.credit),
+            func.max(movements.c.credit),
+            func.count(movements.c.debit),
+            func.coalesce(func.sum(movements.c.debit), 0),
+            func.min(movements.c.debit),
+            func.max(movements.c.debit),
+        ).group_by(movements.c.account_id, start)
+        db.execute(
+            AccountStatement.__table__.insert().from_select(
+                [
+                    "account_id",
+                    "period",
+                    "period_start",
+                    "credit_count",
+                    "credit_total",
+                    "credit_min",
+                    "credit_max",
+                    "debit_count",
+                    "debit_total",
+                    "debit_min",
+                    "debit_max",
+                ],
+                totals,
+            )
+        )
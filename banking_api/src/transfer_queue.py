@@ -0,0 +1,134 @@
+"""
+Module for the write-behind transfer queue with group commit.
+
+With TRANSFER_GROUP_COMMIT set, POST /transactions/transfer/ puts the transfer in an
+in-process queue instead of committing it on its own. A background thread drains the
+queue in micro-batches of up to GROUP_COMMIT_MAX_BATCH transfers, waiting at most
+GROUP_COMMIT_MAX_WAIT_MS for a batch to fill up, and applies every batch with
+transfer_money_batch in best effort mode: one database transaction and one commit (one
+fsync) for the whole batch, a failing transfer does not affect the others. Each caller
+waits on a future resolved with the result of its own transfer.
+
+A transfer is only answered once its batch is committed, nothing is acknowledged before
+it is durable. With the default max wait of 0, a batch is whatever was queued while the
+previous batch was committing, so a lone transfer is not delayed and the batches grow
+with the load. A higher max wait makes bigger batches at moderate load for up to that
+much extra latency, benchmarks/group_commit.py measures the trade-off.
+"""
+
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import List, Optional, Tuple
+
+from banking_operations import transfer_money_batch
+from postgres_interface import SessionLocal, env_flag
+from pydantic_models import TransferRequest
+
+TRANSFER_GROUP_COMMIT = env_flag("TRANSFER_GROUP_COMMIT")
+GROUP_COMMIT_MAX_BATCH = int(os.getenv("GROUP_COMMIT_MAX_BATCH", "100"))
+GROUP_COMMIT_MAX_WAIT_MS = float(os.getenv("GROUP_COMMIT_MAX_WAIT_MS", "0"))
+
+
+class GroupCommitQueue:
+    """
+    Queue of transfers applied in batches by a single background thread.
+    The thread is started by the first submit().
+    """
+
+    def __init__(
+        self,
+        max_batch: int = GROUP_COMMIT_MAX_BATCH,
+        max_wait_ms: float = GROUP_COMMIT_MAX_WAIT_MS,
+        session_factory=SessionLocal,
+    ):
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.session_factory = session_factory
+        self.batches = 0
+        self.transfers = 0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def submit(self, transfer: TransferRequest) -> Future:
+        """
+        Queues a transfer. The future is resolved with the transaction row (a dict with
+        from_account, to_account, amount and timestamp) or with an {"error": ...} dict.
+        """
+        future = Future()
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="transfer-group-commit", daemon=True
+                )
+                self._thread.start()
+        self._queue.put((transfer, future))
+        return future
+
+    def shutdown(self):
+        """Applies the queued transfers and stops the background thread."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def _next_batch(self) -> Tuple[List[Tuple[TransferRequest, Future]], bool]:
+        first = self._queue.get()
+        if first is None:
+            return [], True
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=max(timeout, 0))
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch, stop = self._next_batch()
+            if batch:
+                self._apply(batch)
+
+    def _apply(self, batch: List[Tuple[TransferRequest, Future]]):
+        transfers = [transfer for transfer, _ in batch]
+        db = self.session_factory()
+        try:
+            _, results = transfer_money_batch(db, transfers, atomic=False)
+        except Exception as error:  # pylint: disable=broad-except
+            db.rollback()
+            for _, future in batch:
+                future.set_exception(error)
+            return
+        finally:
+            db.close()
+        self.batches += 1
+        self.transfers += len(batch)
+        for (_, future), result in zip(batch, results):
+            if result["success"]:
+                future.set_result(result["transaction"])
+            else:
+                future.set_result({"error": result["error"]})
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "batches": self.batches,
+            "transfers": self.transfers,
+            "average_batch": (
+                round(self.transfers / self.batches, 2) if self.batches else 0
+            ),
+        }
+
+
+group_commit = GroupCommitQueue()
@@ -5,6 +5,7 @@ sys.path.append(os.path.join(os.path.dirname(__file__), "..", "src"))
 
 import pytest
 from sqlalchemy import text
+from statements import rebuild_statements
 
 
 @pytest.mark.parametrize(
@@ -129,3 +130,106 @@ def test_get_balance_account_not_found(
     )
     assert response.status_code == expected_status_code
     assert response.json()["detail"] == "Account not found"
+
+
+def test_get_balance_cache(test_client, get_jwt_token, test_db):
+    """
+    In this test, we are checking that repeated balance reads are served from the cache
+    and that a transfer drops the cached balances of both accounts.
+    """
+    headers = {"Authorization": f"Bearer {get_jwt_token}"}
+    test_client.get("/accounts/1/balance/", headers=headers)
+    hits = test_client.get("/metrics/balance-cache").json()["hits"]
+    assert test_client.get("/accounts/1/balance/", headers=headers).json()[
+        "balance"
+    ] == (1000.0)
+    assert test_client.get("/metrics/balance-cache").json()["hits"] == hits + 1
+
+    test_client.post(
+        "/transactions/transfer/",
+        json={"from_account": 1, "to_account": 2, "amount": 100.0},
+        headers=headers,
+    )
+    response = test_client.get("/accounts/1/balance/", headers=headers)
+    assert response.json()["balance"] == 900.0
+    response = test_client.get("/accounts/2/balance/", headers=headers)
+    assert response.json()["balance"] == 1600.0
+
+
+def test_create_accounts_bulk(test_client, get_jwt_token, test_db):
+    """
+    In this test, we are creating accounts in bulk and checking the returned ids and
+    balances against the database.
+    """
+    response = test_client.post(
+        "/accounts/bulk",
+        json=[
+            {"customer_id": 1, "initial_deposit": 10.0},
+            {"customer_id": 2, "initial_deposit": 20.0},
+        ],
+        headers={"Authorization": f"Bearer {get_jwt_token}"},
+    )
+    assert response.status_code == 200
+    assert response.json()["created"] == 2
+    for account in response.json()["accounts"]:
+        balance = test_db.execute(
+            text(f"SELECT balance FROM accounts where id = {account['account_id']}")
+        ).scalar()
+        assert balance == account["balance"]
+    assert [account["balance"] for account in response.json()["accounts"]] == [
+        10.0,
+        20.0,
+    ]
+
+    response = test_client.post(
+        "/accounts/bulk",
+        json=[{"customer_id": 99, "initial_deposit": 10.0}],
+        headers={"Authorization": f"Bearer {get_jwt_token}"},
+    )
+    assert response.status_code == 409
+
+
+def test_account_statement(test_client, get_jwt_token, test_db):
+    """
+    In this test, we are checking the statement of an account after a few transfers,
+    and that rebuilding the statements from the transactions gives the same totals.
+    """
+    headers = {"Authorization": f"Bearer {get_jwt_token}"}
+    for from_account, to_account, amount in ((1, 2, 10.0), (1, 3, 30.0), (2, 1, 5.0)):
+        response = test_client.post(
+            "/transactions/transfer/",
+            json={
+                "from_account": from_account,
+                "to_account": to_account,
+                "amount": amount,
+            },
+            headers=headers,
+        )
+        assert response.status_code == 200
+    batch = test_client.post(
+        "/transactions/transfer/batch",
+        json={"transfers": [{"from_account": 3, "to_account": 1, "amount": 7.0}]},
+        headers=headers,
+    )
+    assert batch.json()["committed"]
+
+    def statement(period):
+        response = test_client.get(
+            f"/accounts/1/statement?period={period}", headers=headers
+        )
+        assert response.status_code == 200
+        return response.json()["periods"]
+
+    for period in ("day", "month"):
+        [totals] = statement(period)
+        assert totals["credit"] == {"count": 2, "total": 12.0, "min": 5.0, "max": 7.0}
+        assert totals["debit"] == {"count": 2, "total": 40.0, "min": 10.0, "max": 30.0}
+        assert totals["net"] == -28.0
+
+    test_db.execute(text("DELETE FROM account_statements"))
+    rebuild_statements(test_db)
+    test_db.commit()
+    assert statement("month") == [totals]
+
+    response = test_client.get("/accounts/999/statement", headers=headers)
+    assert response.status_code == 404
@@ -0,0 +1,84 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from postgres_interface import get_async_engine
+from routes import accounts, customers, transactions
+from sqlalchemy import text
+
+
+@pytest.fixture(scope="module")
+def async_client(test_client):
+    """
+    This fixture will create a test client for an application serving only the async
+    routes, the same way main.py registers them when USE_ASYNC_DB is set.
+    """
+    app = FastAPI()
+    app.include_router(accounts.async_router, prefix="/accounts")
+    app.include_router(transactions.async_router, prefix="/transactions")
+    app.include_router(customers.async_router, prefix="/customers")
+    with TestClient(app) as client:
+        yield client
+        # The pooled asyncpg connections belong to the event loop of this client
+        client.portal.call(get_async_engine().dispose)
+
+
+def test_create_customer_and_account_async(async_client, get_jwt_token, test_db):
+    """
+    In this test, we are creating a customer and an account for it through the async routes
+    and reading the balance back.
+    """
+    headers = {"Authorization": f"Bearer {get_jwt_token}"}
+    response = async_client.post(
+        "/customers/create/", json={"id": 5, "name": "Bob"}, headers=headers
+    )
+    assert response.status_code == 200
+    assert response.json() == {"id": 5, "name": "Bob"}
+
+    response = async_client.post(
+        "/accounts/create/",
+        json={"customer_id": 5, "initial_deposit": 300.0},
+        headers=headers,
+    )
+    assert response.status_code == 200
+    account_id = response.json()["account_id"]
+
+    response = async_client.get(f"/accounts/{account_id}/balance/", headers=headers)
+    assert response.status_code == 200
+    assert response.json() == {"account_id": account_id, "balance": 300.0}
+
+
+def test_transfer_and_history_async(async_client, get_jwt_token, test_db):
+    """
+    In this test, we are transferring funds through the async routes and checking the
+    balances in the database, the transfer history and the statement.
+    """
+    headers = {"Authorization": f"Bearer {get_jwt_token}"}
+    response = async_client.post(
+        "/transactions/transfer/",
+        json={"from_account": 1, "to_account": 2, "amount": 75.0},
+        headers=headers,
+    )
+    assert response.status_code == 200
+    assert response.json()["amount"] == 75.0
+
+    balances = dict(
+        test_db.execute(text("SELECT id, balance FROM accounts")).fetchall()
+    )
+    assert balances[1] == 1000.0 - 75.0
+    assert balances[2] == 1500.0 + 75.0
+
+    response = async_client.get("/transactions/history/2", headers=headers)
+    assert response.status_code == 200
+    assert response.json()["history"][0]["from_account"] == 1
+    assert response.json()["history"][0]["to_account"] == 2
+
+    response = async_client.get("/accounts/2/statement?period=day", headers=headers)
+    assert response.status_code == 200
+    [totals] = response.json()["periods"]
+    assert totals["credit"] == {"count": 1, "total": 75.0, "min": 75.0, "max": 75.0}
+    assert totals["debit"]["count"] == 0
@@ -19,3 +19,48 @@ def test_login_user(test_client):
     assert "access_token" in response.json()
     assert response.json()["token_type"] == "bearer"
     assert response.json()["access_token"] is not None
+
+
+def test_login_user_password_cache(test_client):
+    """
+    In this test, we are checking that a repeated login is served from the cache of
+    verified passwords, and that a wrong password is neither accepted nor cached.
+    """
+    import security
+
+    login = {"username": "admin", "password": "admin123"}
+    assert test_client.post("/auth/token", data=login).status_code == 200
+    hits = security.verified_passwords.hits
+    assert test_client.post("/auth/token", data=login).status_code == 200
+    assert security.verified_passwords.hits == hits + 1
+
+    size = len(security.verified_passwords)
+    response = test_client.post(
+        "/auth/token", data={"username": "admin", "password": "wrong"}
+    )
+    assert response.status_code == 401
+    assert len(security.verified_passwords) == size
+
+
+def test_access_token_cache(test_client):
+    """
+    In this test, we are checking that a verified token is served from the token cache
+    and that an expired token is rejected.
+    """
+    from datetime import timedelta
+
+    import security
+
+    token = security.create_access_token(data={"sub": "cached_user"})
+    assert security.get_current_user(token) == "cached_user"
+    hits = security.validated_tokens.hits
+    assert security.get_current_user(token) == "cached_user"
+    assert security.validated_tokens.hits == hits + 1
+
+    expired_token = security.create_access_token(
+        data={"sub": "admin"}, expires_delta=timedelta(minutes=-1)
+    )
+    response = test_client.get(
+        "/accounts/1/balance/", headers={"Authorization": f"Bearer {expired_token}"}
+    )
+    assert response.status_code == 401
@@ -45,3 +45,44 @@ def test_create_new_customer(
     assert customer is not None
     assert customer[1] == name
     assert customer[0] == customer_id
+
+
+def test_create_customers_bulk(test_client, get_jwt_token, test_db):
+    """
+    In this test, we are creating customers in bulk from a JSON array and from NDJSON,
+    with a chunk size smaller than the number of customers.
+    """
+    headers = {"Authorization": f"Bearer {get_jwt_token}"}
+    response = test_client.post(
+        "/customers/bulk",
+        params={"chunk_size": 2},
+        json=[
+            {"id": customer_id, "name": f"Bulk {customer_id}"}
+            for customer_id in (5, 6, 7)
+        ],
+        headers=headers,
+    )
+    assert response.status_code == 200
+    assert response.json() == {"created": 3, "ids": [5, 6, 7]}
+
+    response = test_client.post(
+        "/customers/bulk",
+        content='{"id": 8, "name": "Bulk 8"}\n{"id": 9, "name": "Bulk 9"}\n',
+        headers={**headers, "Content-Type": "application/x-ndjson"},
+    )
+    assert response.status_code == 200
+    assert response.json() == {"created": 2, "ids": [8, 9]}
+
+    names = test_db.execute(
+        text("SELECT name FROM customers WHERE id >= 5 ORDER BY id")
+    ).scalars()
+    assert list(names) == [f"Bulk {customer_id}" for customer_id in range(5, 10)]
+
+    response = test_client.post(
+        "/customers/bulk",
+        params={"chunk_size": 1},
+        json=[{"id": 10, "name": "Bulk 10"}, {"id": 5, "name": "Duplicate"}],
+        headers=headers,
+    )
+    assert response.status_code == 409
+    assert response.json()["detail"]["created"] == [10]
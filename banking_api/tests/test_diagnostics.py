@@ -0,0 +1,118 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import diagnostics
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from postgres_interface import SessionLocal
+from pydantic_models import DiagnosticsSettingsUpdate
+from sqlalchemy import text
+
+
+@pytest.fixture
+def enabled_diagnostics(tmp_path, monkeypatch):
+    """
+    This fixture will enable the diagnostics for one test, with every query reported as
+    slow and every request profiled, and restore the previous settings afterwards.
+    """
+    monkeypatch.setattr(diagnostics, "PROFILE_DIR", str(tmp_path))
+    monkeypatch.setattr(diagnostics, "PROFILE_INTERVAL_MS", 1)
+    previous = diagnostics.settings
+    diagnostics.instrument_engines()
+    yield diagnostics.update_settings(
+        DiagnosticsSettingsUpdate(enabled=True, slow_query_ms=0, profile_sample_rate=1)
+    )
+    diagnostics.settings = previous
+    for findings in (
+        diagnostics.slow_queries,
+        diagnostics.repeated_queries,
+        diagnostics.profiles,
+    ):
+        findings.clear()
+
+
+def test_update_diagnostics_settings(test_client, get_jwt_token):
+    """
+    In this test, we are changing the diagnostics settings through the API.
+    Changing them requires a token, and the settings left out keep their value.
+    """
+    previous = diagnostics.settings
+    response = test_client.patch("/metrics/diagnostics", json={"slow_query_ms": 5})
+    assert response.status_code == 401
+
+    response = test_client.patch(
+        "/metrics/diagnostics",
+        json={"slow_query_ms": 5},
+        headers={"Authorization": f"Bearer {get_jwt_token}"},
+    )
+    try:
+        assert response.status_code == 200
+        assert response.json()["slow_query_ms"] == 5
+        assert response.json()["enabled"] == previous.enabled
+        assert test_client.get("/metrics/diagnostics").json()["settings"] == (
+            response.json()
+        )
+    finally:
+        diagnostics.settings = previous
+
+
+def test_slow_query_with_plan(test_client, get_jwt_token, test_db, enabled_diagnostics):
+    """
+    In this test, we are checking that the slow queries of a request are reported with
+    the route and the plan of the query.
+    """
+    response = test_client.post(
+        "/transactions/transfer/",
+        json={"from_account": 1, "to_account": 2, "amount": 10.0},
+        headers={"Authorization": f"Bearer {get_jwt_token}"},
+    )
+    assert response.status_code == 200
+
+    slow_queries = test_client.get("/metrics/diagnostics").json()["slow_queries"]
+    updates = [
+        query
+        for query in slow_queries
+        if query["statement"].startswith("UPDATE accounts")
+        and query["route"] == "/transactions/transfer/"
+    ]
+    assert updates
+    assert "accounts" in updates[0]["plan"]
+    assert not updates[0]["plan"].startswith("EXPLAIN failed")
+
+
+def test_repeated_queries_and_profile(enabled_diagnostics):
+    """
+    In this test, we are checking that a route running the same query once per item is
+    flagged, and that the sampled request is profiled into a folded stacks file.
+    """
+    app = FastAPI()
+    app.add_middleware(diagnostics.DiagnosticsMiddleware)
+
+    @app.get("/accounts/{account_id}/owners")
+    def owners(account_id: int):
+        with SessionLocal() as db:
+            return [
+                db.execute(
+                    text("SELECT customer_id FROM accounts WHERE id = :id"),
+                    {"id": owner_account},
+                ).scalar()
+                for owner_account in (1, 2, 3)
+            ]
+
+    with TestClient(app) as client:
+        assert client.get("/accounts/1/owners").status_code == 200
+
+    [repeated] = diagnostics.repeated_queries
+    assert repeated["route"] == "/accounts/{account_id}/owners"
+    assert repeated["count"] == 3
+
+    [profile] = diagnostics.profiles
+    assert os.path.exists(profile["path"])
+    with open(profile["path"]) as folded:
+        for line in folded:
+            stack, count = line.rsplit(" ", 1)
+            assert int(count) >= 1
+            assert ";" in stack
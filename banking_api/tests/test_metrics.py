@@ -0,0 +1,67 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "src"))
+
+
+def test_db_pool_metrics(test_client, get_jwt_token):
+    """
+    In this test, we are checking the connection pool metrics.
+    After a request that used the database, the wait time histogram should have samples.
+    """
+    test_client.get(
+        "/accounts/1/balance/", headers={"Authorization": f"Bearer {get_jwt_token}"}
+    )
+    response = test_client.get("/metrics/db-pool")
+    assert response.status_code == 200
+
+    sync_pool = response.json()["sync"]
+    assert sync_pool["checked_out"] + sync_pool["idle"] >= 1
+    assert sync_pool["overflow"] >= 0
+    assert sync_pool["wait_time_seconds"]["count"] >= 1
+    assert sync_pool["wait_time_seconds"]["buckets"]["+Inf"] == (
+        sync_pool["wait_time_seconds"]["count"]
+    )
+
+
+def test_server_timing_header(test_client, get_jwt_token):
+    """
+    In this test, we are checking the Server-Timing header of a response.
+    Reading the history runs at least one query, which should be reported with its
+    database time next to the total time of the request.
+    """
+    response = test_client.get(
+        "/transactions/history/1", headers={"Authorization": f"Bearer {get_jwt_token}"}
+    )
+    assert response.status_code == 200
+
+    timings = {
+        metric.split(";")[0]: metric
+        for metric in response.headers["Server-Timing"].split(", ")
+    }
+    assert "app" in timings
+    assert "db" in timings
+    assert 'desc="0 queries"' not in timings["db"]
+
+
+def test_prometheus_metrics(test_client, get_jwt_token):
+    """
+    In this test, we are checking the Prometheus metrics.
+    The request latency should be reported per route template, not per path, together
+    with the query count of the route and the connection pool.
+    """
+    test_client.get(
+        "/accounts/1/balance/", headers={"Authorization": f"Bearer {get_jwt_token}"}
+    )
+    response = test_client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+
+    labels = 'method="GET",route="/accounts/{account_id}/balance/"'
+    lines = response.text.splitlines()
+    assert f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}}' in " ".join(
+        lines
+    )
+    assert any(line.startswith(f"db_queries_total{{{labels}}}") for line in lines)
+    assert not any('route="/accounts/1/balance/"' in line for line in lines)
+    assert any(line.startswith('db_pool_checked_out{pool="sync"}') for line in lines)
@@ -0,0 +1,24 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from migrations import MIGRATIONS, run_migrations
+from postgres_interface import engine
+from sqlalchemy import inspect, text
+
+
+def test_run_migrations(test_client):
+    """
+    In this test, we are checking that every migration is recorded once applied
+    and that running the migrations again does not apply anything.
+    """
+    assert run_migrations(engine) == []
+
+    with engine.connect() as conn:
+        versions = conn.execute(text("SELECT version FROM schema_migrations")).scalars()
+        assert set(versions) >= {version for version, _ in MIGRATIONS}
+
+    indexes = {index["name"] for index in inspect(engine).get_indexes("transactions")}
+    assert "ix_transactions_from_account_timestamp" in indexes
+    assert "ix_transactions_to_account_timestamp" in indexes
@@ -0,0 +1,61 @@
+import gzip
+import os
+import sys
+from datetime import datetime
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import partitions
+from postgres_interface import engine
+from sqlalchemy import text
+
+
+def test_transactions_partitioned(test_client):
+    """
+    In this test, we are checking that the transactions table is partitioned by month
+    and that the partitions of the next months exist.
+    """
+    with engine.connect() as conn:
+        assert partitions.is_partitioned(conn)
+        names = {name for name, _, _ in partitions.list_partitions(conn)}
+    month = partitions.month_start(datetime.utcnow())
+    for months in range(partitions.PARTITION_MONTHS_AHEAD + 1):
+        assert partitions.partition_name(partitions.add_months(month, months)) in names
+
+
+def test_ensure_and_archive_partitions(test_client, test_db, tmp_path):
+    """
+    In this test, we are inserting a transaction older than all the partitions, which
+    lands in the default partition, then creating its partition, which moves it there,
+    and archiving that partition to a gzipped CSV file.
+    """
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                "INSERT INTO transactions (from_account, to_account, amount, timestamp) "
+                "VALUES (1, 2, 12.5, '2001-01-15 10:00:00')"
+            )
+        )
+        assert partitions.ensure_partitions(
+            conn, datetime(2001, 1, 1), datetime(2001, 2, 1)
+        ) == ["transactions_2001_01"]
+        assert conn.execute(text("SELECT count(*) FROM transactions_2001_01")).scalar()
+        assert not conn.execute(
+            text("SELECT count(*) FROM transactions_default")
+        ).scalar()
+
+    [archived] = partitions.archive_partitions(engine, datetime(2001, 2, 1), tmp_path)
+    assert archived["partition"] == "transactions_2001_01"
+    assert archived["rows"] == 1
+    with gzip.open(archived["path"], "rt") as archive:
+        header, row = archive.read().splitlines()
+    assert header == ",".join(partitions.ARCHIVE_COLUMNS)
+    assert row.endswith(",1,2,12.5,2001-01-15 10:00:00")
+
+    with engine.connect() as conn:
+        names = {name for name, _, _ in partitions.list_partitions(conn)}
+        assert "transactions_2001_01" not in names
+        assert (
+            conn.execute(text("SELECT to_regclass('transactions_2001_01')")).scalar()
+            is None
+        )
@@ -0,0 +1,82 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import pytest
+import replicas
+from balance_cache import balances
+from postgres_interface import Base, engine
+from postgres_models import Account, Customer
+from replicas import ReplicaSet, RoutingSession
+from sqlalchemy import create_engine, select, update
+
+
+@pytest.fixture
+def replica_set(tmp_path):
+    """
+    This fixture will create a replica set with a SQLite replica, whose account 1 has a
+    balance of 42 where the primary has 1000.
+    """
+    url = f"sqlite:///{tmp_path / 'replica.db'}"
+    replica_engine = create_engine(url)
+    Base.metadata.create_all(
+        replica_engine, tables=[Customer.__table__, Account.__table__]
+    )
+    with replica_engine.begin() as conn:
+        conn.execute(Customer.__table__.insert(), {"id": 1, "name": "Replica"})
+        conn.execute(
+            Account.__table__.insert(), {"id": 1, "customer_id": 1, "balance": 42.0}
+        )
+    replica_engine.dispose()
+
+    replica_set = ReplicaSet([url], max_lag=5)
+    replica_set.check()
+    yield replica_set
+    for replica in replica_set.replicas:
+        replica.engine.dispose()
+
+
+def test_routing_session(test_client, test_db, replica_set, monkeypatch):
+    """
+    In this test, we are checking that a routing session reads from the replica, that
+    its writes and the reads following them go to the primary, and that a lagging
+    replica is ejected.
+    """
+    [replica] = replica_set.replicas
+    assert replica.healthy and replica.lag == 0
+
+    with RoutingSession(bind=engine, replica_set=replica_set) as db:
+        assert db.scalar(select(Account.balance).where(Account.id == 1)) == 42.0
+        assert db.get_bind(clause=select(Account).with_for_update()) is engine
+        db.execute(update(Account).where(Account.id == 1).values(balance=999.0))
+        # The session reads its own write from the primary, which is rolled back
+        assert db.scalar(select(Account.balance).where(Account.id == 1)) == 999.0
+        db.rollback()
+
+    monkeypatch.setattr(replicas, "measure_lag", lambda conn: 60.0)
+    replica_set.check()
+    assert not replica.healthy
+    with RoutingSession(bind=engine, replica_set=replica_set) as db:
+        assert db.scalar(select(Account.balance).where(Account.id == 1)) == 1000.0
+
+
+def test_read_routes_use_replicas(test_client, get_jwt_token, replica_set, monkeypatch):
+    """
+    In this test, we are reading a balance through the API with a replica configured.
+    It comes from the replica unless the request asks to read its own writes, and the
+    balances read from the replica are not cached.
+    """
+    monkeypatch.setattr(replicas, "replica_set", replica_set)
+    headers = {"Authorization": f"Bearer {get_jwt_token}"}
+    balances.clear()
+
+    response = test_client.get("/accounts/1/balance/", headers=headers)
+    assert response.json()["balance"] == 42.0
+    assert balances.get(1) is None
+
+    response = test_client.get(
+        "/accounts/1/balance/", headers={**headers, "X-Read-Your-Writes": "true"}
+    )
+    assert response.json()["balance"] == 1000.0
+    balances.clear()
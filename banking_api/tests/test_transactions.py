@@ -3,8 +3,19 @@ import sys
 
 sys.path.append(os.path.join(os.path.dirname(__file__), "..", "src"))
 
+import csv
+import json
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import idempotency
 import pytest
+import responses
+from pydantic_models import TransferRequest
+from routes import transactions
 from sqlalchemy import text
+from transfer_queue import GroupCommitQueue
 
 
 @pytest.mark.parametrize(
@@ -137,3 +148,362 @@ def test_transfter_more_than_balance(
             },
             headers={"Authorization": f"Bearer {get_jwt_token}"},
         )
+
+
+def test_transfer_funds_batch(
+    test_client,
+    get_jwt_token,
+    test_db,
+):
+    """
+    In this test, we are testing a best effort batch transfer.
+    The valid transfers are committed in one go and the failing one is reported per item.
+    """
+    response = test_client.post(
+        "/transactions/transfer/batch",
+        json={
+            "mode": "best_effort",
+            "transfers": [
+                {"from_account": 1, "to_account": 2, "amount": 100.0},
+                {"from_account": 2, "to_account": 3, "amount": 1000000.0},
+                {"from_account": 4, "to_account": 1, "amount": 50.0},
+            ],
+        },
+        headers={"Authorization": f"Bearer {get_jwt_token}"},
+    )
+    assert response.status_code == 200
+    assert response.json()["committed"] is True
+    assert response.json()["succeeded"] == 2
+    assert response.json()["failed"] == 1
+    assert [result["success"] for result in response.json()["results"]] == [
+        True,
+        False,
+        True,
+    ]
+
+    balances = dict(
+        test_db.execute(text("SELECT id, balance FROM accounts")).fetchall()
+    )
+    assert balances[1] == 1000.0 - 100.0 + 50.0
+    assert balances[2] == 1500.0 + 100.0
+    assert balances[3] == 2000.0
+    assert balances[4] == 2500.0 - 50.0
+
+
+def test_transfer_funds_batch_all_or_nothing(
+    test_client,
+    get_jwt_token,
+    test_db,
+):
+    """
+    In this test, we are testing that a failing transfer rolls back the whole batch
+    in all or nothing mode.
+    """
+    response = test_client.post(
+        "/transactions/transfer/batch",
+        json={
+            "transfers": [
+                {"from_account": 1, "to_account": 2, "amount": 100.0},
+                {"from_account": 1, "to_account": 99, "amount": 10.0},
+            ],
+        },
+        headers={"Authorization": f"Bearer {get_jwt_token}"},
+    )
+    assert response.status_code == 200
+    assert response.json()["committed"] is False
+    assert response.json()["succeeded"] == 0
+    assert response.json()["failed"] == 2
+
+    balances = dict(
+        test_db.execute(text("SELECT id, balance FROM accounts")).fetchall()
+    )
+    assert balances[1] == 1000.0
+    assert balances[2] == 1500.0
+    transactions = test_db.execute(text("SELECT count(*) FROM transactions")).scalar()
+    assert transactions == 0
+
+
+@pytest.mark.parametrize("strategy", ["atomic_update", "row_lock"])
+def test_concurrent_transfers_do_not_lose_money(test_client, test_db, strategy):
+    """
+    In this test, we are hammering account 1 from several threads at once.
+    Half of the threads send money to account 1 and the other half send money out of it,
+    so the threads contend on the same row in both directions.
+    No transfer should fail and the final balances should add up to the cent.
+    """
+    from banking_operations import transfer_money
+    from postgres_interface import SessionLocal
+    from pydantic_models import TransferRequest
+
+    threads, transfers_per_thread = 8, 25
+
+    def worker(thread_index):
+        other_account = 2 + thread_index % 3
+        if thread_index % 2:
+            from_account, to_account = 1, other_account
+        else:
+            from_account, to_account = other_account, 1
+        db = SessionLocal()
+        try:
+            return [
+                transfer_money(
+                    db,
+                    TransferRequest(
+                        from_account=from_account, to_account=to_account, amount=1.0
+                    ),
+                    strategy=strategy,
+                )
+                for _ in range(transfers_per_thread)
+            ]
+        finally:
+            db.close()
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        results = [
+            result
+            for thread_results in executor.map(worker, range(threads))
+            for result in thread_results
+        ]
+
+    assert not [result for result in results if isinstance(result, dict)]
+    balances = dict(
+        test_db.execute(text("SELECT id, balance FROM accounts")).fetchall()
+    )
+    assert balances[1] == 1000.0
+    assert sum(balances.values()) == 1000.0 + 1500.0 + 2000.0 + 2500.0
+    transactions = test_db.execute(text("SELECT count(*) FROM transactions")).scalar()
+    assert transactions == threads * transfers_per_thread
+
+
+def test_get_transfer_history_pages(
+    test_client,
+    get_jwt_token,
+    test_db,
+):
+    """
+    In this test, we are walking through the transfer history one page at a time.
+    The pages should be newest first, without gaps or duplicates, and the last page
+    should not have a next cursor.
+    """
+    headers = {"Authorization": f"Bearer {get_jwt_token}"}
+    for amount in range(1, 6):
+        response = test_client.post(
+            "/transactions/transfer/",
+            json={"from_account": 1, "to_account": 2, "amount": amount},
+            headers=headers,
+        )
+        assert response.status_code == 200
+
+    amounts = []
+    cursor = None
+    while True:
+        params = {"limit": 2}
+        if cursor:
+            params["after"] = cursor
+        response = test_client.get(
+            "/transactions/history/2", params=params, headers=headers
+        )
+        assert response.status_code == 200
+        assert len(response.json()["history"]) <= 2
+        amounts += [row["amount"] for row in response.json()["history"]]
+        cursor = response.json()["next_cursor"]
+        if cursor is None:
+            break
+
+    assert amounts == [5, 4, 3, 2, 1]
+
+    response = test_client.get(
+        "/transactions/history/2", params={"after": "not-a-cursor"}, headers=headers
+    )
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize("validate", [True, False])
+def test_history_fast_json(test_client, get_jwt_token, test_db, monkeypatch, validate):
+    """
+    In this test, we are checking that the fast JSON responses of the history and of the
+    batch transfers have the same content as the default ones.
+    """
+    headers = {"Authorization": f"Bearer {get_jwt_token}"}
+    batch = {
+        "transfers": [
+            {"from_account": 1, "to_account": 2, "amount": 10.5},
+            {"from_account": 2, "to_account": 3, "amount": 99999.0},
+        ],
+        "mode": "best_effort",
+    }
+    default_batch = test_client.post(
+        "/transactions/transfer/batch", json=batch, headers=headers
+    ).json()
+    default_history = test_client.get(
+        "/transactions/history/2", params={"limit": 1}, headers=headers
+    )
+
+    monkeypatch.setattr(responses, "FAST_JSON", True)
+    monkeypatch.setattr(responses, "FAST_JSON_VALIDATE", validate)
+    fast_batch = test_client.post(
+        "/transactions/transfer/batch", json=batch, headers=headers
+    ).json()
+    fast_history = test_client.get(
+        "/transactions/history/2", params={"limit": 1}, headers=headers
+    )
+    assert fast_history.headers["content-type"] == "application/json"
+    assert fast_history.json()["history"][0]["amount"] == 10.5
+    assert fast_history.json()["history"][0]["from_account"] == 1
+    assert fast_history.json()["next_cursor"] is not None
+
+    # The second batch made newer transfers, only their timestamps differ
+    for response in (default_batch, fast_batch):
+        for result in response["results"]:
+            if result["transaction"]:
+                result["transaction"].pop("timestamp")
+    assert fast_batch == default_batch
+    assert fast_history.json().keys() == default_history.json().keys()
+
+
+@pytest.mark.parametrize("file_format", ["ndjson", "csv"])
+def test_export_transfer_history(
+    test_client,
+    get_jwt_token,
+    test_db,
+    file_format,
+):
+    """
+    In this test, we are exporting the transfer history as NDJSON and CSV.
+    """
+    headers = {"Authorization": f"Bearer {get_jwt_token}"}
+    for amount in (10, 20):
+        test_client.post(
+            "/transactions/transfer/",
+            json={"from_account": 3, "to_account": 4, "amount": amount},
+            headers=headers,
+        )
+
+    response = test_client.get(
+        "/transactions/history/3/export",
+        params={"format": file_format},
+        headers=headers,
+    )
+    assert response.status_code == 200
+    lines = response.text.splitlines()
+    if file_format == "ndjson":
+        rows = [json.loads(line) for line in lines]
+    else:
+        rows = list(csv.DictReader(lines))
+    assert [float(row["amount"]) for row in rows] == [20.0, 10.0]
+    assert all(int(row["from_account"]) == 3 for row in rows)
+
+
+def test_transfer_with_idempotency_key(test_client, get_jwt_token, test_db):
+    """
+    In this test, we are retrying a transfer with the same Idempotency-Key.
+    The retries get the response of the first request, from the in-memory cache and
+    from the table, and the money is only transferred once. Reusing the key for another
+    transfer is rejected.
+    """
+    headers = {
+        "Authorization": f"Bearer {get_jwt_token}",
+        "Idempotency-Key": str(uuid.uuid4()),
+    }
+    transfer = {"from_account": 1, "to_account": 2, "amount": 100.0}
+
+    first = test_client.post("/transactions/transfer/", json=transfer, headers=headers)
+    assert first.status_code == 200
+    assert "Idempotent-Replayed" not in first.headers
+
+    retry = test_client.post("/transactions/transfer/", json=transfer, headers=headers)
+    idempotency.recent_keys.clear()
+    retry_from_table = test_client.post(
+        "/transactions/transfer/", json=transfer, headers=headers
+    )
+    for response in (retry, retry_from_table):
+        assert response.status_code == 200
+        assert response.headers["Idempotent-Replayed"] == "true"
+        assert response.json() == first.json()
+
+    transactions = test_db.execute(
+        text("SELECT COUNT(*) FROM transactions WHERE from_account = 1")
+    ).scalar()
+    assert transactions == 1
+    balance = test_db.execute(
+        text("SELECT balance FROM accounts WHERE id = 1")
+    ).scalar()
+    assert balance == 900.0
+
+    response = test_client.post(
+        "/transactions/transfer/", json={**transfer, "amount": 50.0}, headers=headers
+    )
+    assert response.status_code == 422
+
+
+def test_delete_expired_idempotency_keys(test_db):
+    """
+    In this test, we are checking that the cleanup deletes the expired keys in batches
+    and keeps the others.
+    """
+    now = datetime.utcnow()
+    for number in range(5):
+        record = idempotency.new_record("admin", f"expired-{number}", "hash")
+        record.response = "{}"
+        record.expires_at = now - timedelta(minutes=1)
+        test_db.add(record)
+    record = idempotency.new_record("admin", "valid", "hash")
+    record.response = "{}"
+    test_db.add(record)
+    test_db.commit()
+
+    assert idempotency.delete_expired(test_db, batch_size=2) == 5
+    remaining = test_db.execute(
+        text("SELECT idempotency_key FROM idempotency_keys")
+    ).scalars()
+    assert list(remaining) == ["valid"]
+
+
+def test_group_commit_queue(test_db):
+    """
+    In this test, we are queueing concurrent transfers in a group commit queue.
+    They should be committed in fewer batches than transfers, and every caller should get
+    the result of its own transfer, including the one failing for insufficient funds.
+    """
+    queue = GroupCommitQueue(max_batch=50, max_wait_ms=50)
+    transfers = [
+        TransferRequest(from_account=3, to_account=4, amount=10.0) for _ in range(20)
+    ]
+    transfers.append(TransferRequest(from_account=1, to_account=2, amount=5000.0))
+    try:
+        with ThreadPoolExecutor(max_workers=len(transfers)) as executor:
+            futures = list(executor.map(queue.submit, transfers))
+        results = [future.result(timeout=10) for future in futures]
+    finally:
+        queue.shutdown()
+
+    assert all(result["amount"] == 10.0 for result in results[:-1])
+    assert results[-1] == {"error": "Insufficient funds, please check the balance"}
+    assert queue.stats()["transfers"] == 21
+    assert queue.stats()["batches"] < 21
+
+    balance = test_db.execute(
+        text("SELECT balance FROM accounts WHERE id = 3")
+    ).scalar()
+    assert balance == 1800.0
+
+
+def test_transfer_funds_group_commit(test_client, get_jwt_token, test_db, monkeypatch):
+    """
+    In this test, we are sending a transfer with the group commit mode on.
+    The response should be the same as without it.
+    """
+    monkeypatch.setattr(transactions, "TRANSFER_GROUP_COMMIT", True)
+    response = test_client.post(
+        "/transactions/transfer/",
+        json={"from_account": 1, "to_account": 2, "amount": 100.0},
+        headers={"Authorization": f"Bearer {get_jwt_token}"},
+    )
+    assert response.status_code == 200
+    assert response.json()["from_account"] == 1
+    assert response.json()["amount"] == 100.0
+
+    balance = test_db.execute(
+        text("SELECT balance FROM accounts WHERE id = 2")
+    ).scalar()
+    assert balance == 1600.0